@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Compare decoding large mmap'd inputs with and without copying to bytes.
+
+Decodes a temporary UTF-8 file (whole, and in slices) through `as_text` and
+`iter_text`, once copying every buffer to bytes first, and once passing the
+memoryview slices as is. `as_text` decodes a memoryview without a copy, but
+the incremental decoder used by `iter_text` copies every chunk anyway, so
+the two `iter_text` cases only compare the explicit copy.
+"""
+
+
+import argparse
+import mmap
+import tempfile
+import timeit
+
+from ostrich.utils.text import as_text, iter_text
+
+
+_LINE = 'café naïve € 0123456789 abcdefghij\n'.encode('utf-8')
+
+
+def make_input(size_mb):
+    """Return a temporary file of about `size_mb` MB of UTF-8 text."""
+    temp_f = tempfile.TemporaryFile()
+    block = _LINE * (1024 * 1024 // len(_LINE))
+    for _ in range(size_mb):
+        temp_f.write(block)
+    temp_f.flush()
+    return temp_f
+
+
+def slices(view, chunk_size):
+    """Return memoryview slices of `view`, `chunk_size` bytes each."""
+    return [view[pos:pos + chunk_size]
+            for pos in range(0, len(view), chunk_size)]
+
+
+def run_benchmarks(view, chunk_size, repeat):
+    """Return a list of (name, best time) of the benchmarks on the `view`
+       buffer."""
+    chunks = slices(view, chunk_size)
+    benchmarks = [
+        ('as_text copy', lambda: as_text(view.tobytes())),
+        ('as_text zero-copy', lambda: as_text(view)),
+        ('iter_text copy',
+         lambda: sum(1 for _ in iter_text(chunk.tobytes()
+                                          for chunk in chunks))),
+        ('iter_text memoryview', lambda: sum(1 for _ in iter_text(chunks))),
+    ]
+    return [(name, min(timeit.repeat(func, number=1, repeat=repeat)))
+            for name, func in benchmarks]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    with make_input(args.size_mb) as temp_f:
+        mapped = mmap.mmap(temp_f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            results = run_benchmarks(memoryview(mapped), args.chunk_size,
+                                     args.repeat)
+        finally:
+            mapped.close()
+    for name, best in results:
+        print('{0:<20} {1:8.1f} ms  {2:8.1f} MB/s'.format(
+            name, best * 1000, args.size_mb / best))
+
+
+if __name__ == '__main__':
+    main()
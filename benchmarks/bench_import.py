@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Measure the import time of every ostrich.utils module.
+
+Every module is imported in a fresh interpreter with `-X importtime`
+(Python 3.7+), reporting the best cumulative import time of the module, and
+whether the "future" library (future / past packages) was imported too.
+"""
+
+
+import argparse
+from os.path import abspath, dirname
+import os
+import subprocess
+import sys
+
+
+MODULES = ['ostrich.utils.collections', 'ostrich.utils.path',
+           'ostrich.utils.proc', 'ostrich.utils.text']
+FUTURE_PACKAGES = ('future', 'past')
+
+
+def import_times(module):
+    """Return a dict of module name -> (self, cumulative) import time in
+       microseconds, of importing `module` in a new interpreter."""
+    env = dict(os.environ, PYTHONPATH=dirname(dirname(abspath(__file__))))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.PIPE, universal_newlines=True, env=env, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_us), int(cumulative_us)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    args = parser.parse_args()
+    print('{0:<28} {1:>10}  {2}'.format('module', 'total', 'future'))
+    for module in args.modules:
+        best_total = None
+        for _ in range(args.repeat):
+            times = import_times(module)
+            total = times[module][1]
+            if best_total is None or total < best_total:
+                best_total = total
+        uses_future = any(name.split('.')[0] in FUTURE_PACKAGES
+                          for name in times)
+        print('{0:<28} {1:>7.1f} ms  {2}'.format(
+            module, best_total / 1000., 'yes' if uses_future else 'no'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Compare listify with its previous, isinstance-chain implementation."""
+
+
+import argparse
+from types import GeneratorType
+import timeit
+
+try:
+    from past.builtins import xrange
+except ImportError:
+    xrange = range  # pylint: disable=invalid-name
+
+from ostrich.utils.collections import listify
+
+
+def listify_isinstance(args):
+    """The previous listify implementation."""
+    if args:
+        if isinstance(args, list):
+            return args
+        elif isinstance(args, (set, tuple, GeneratorType,
+                               range, xrange)):
+            return list(args)
+        return [args]
+    return []
+
+
+CASES = [
+    ('list', [1, 2, 3]),
+    ('tuple', (1, 2, 3)),
+    ('set', set([1, 2, 3])),
+    ('range', range(3)),
+    ('int', 1),
+    ('str', 'foo'),
+    ('None', None),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print('{0:<8} {1:>12} {2:>12}'.format('case', 'isinstance', 'dispatch'))
+    for name, value in CASES:
+        times = [min(timeit.repeat(lambda: func(value), number=args.number,
+                                   repeat=args.repeat))
+                 for func in (listify_isinstance, listify)]
+        print('{0:<8} {1:>9.1f} ns {2:>9.1f} ns'.format(
+            name, *(t * 1e9 / args.number for t in times)))
+
+
+if __name__ == '__main__':
+    main()
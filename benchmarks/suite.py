@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark suite for the ostrich.utils hot paths.
+
+Runs realistic workloads (large path manifests, mixed-unicode file names,
+many short subprocesses...), optionally writing the results to a JSON file,
+and comparing them with a saved baseline to flag regressions.
+"""
+
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import timeit
+
+from ostrich.utils.collections import listify
+from ostrich.utils.path import (
+    CommonPathAccumulator, PathTrie, commonpath, commonpath_many)
+from ostrich.utils.proc import PIPE, run, run_many
+from ostrich.utils.text import as_text, get_safe_path, get_safe_paths
+
+
+_WORDS = ['usr', 'lib', 'python3', 'site-packages', 'ostrich', 'utils',
+          'data', 'build', 'src', 'tests', 'docs', 'café', 'naïve']
+_NAMES = ['report 2016-01-01.pdf', 'café menu (final).docx',
+          'עוגיות.txt', 'résumé.odt',
+          'IMG_0001.JPG', '  spaced out  ', 'Ångström.csv',
+          'data–set™.json', 'plain_ascii_name.txt']
+
+
+def manifest(size, seed=0):
+    """Return a deterministic list of `size` absolute paths, sharing the
+       '/srv/data' root."""
+    rand = random.Random(seed)
+    return ['/srv/data/' + '/'.join(rand.choice(_WORDS)
+                                    for _ in range(rand.randint(1, 8)))
+            for _ in range(size)]
+
+
+def file_names(size, unique, seed=0):
+    """Return a deterministic list of `size` mixed-unicode file names, with
+       `unique` distinct ones."""
+    rand = random.Random(seed)
+    distinct = ['{0} {1}'.format(rand.randint(0, 10 ** 6),
+                                 rand.choice(_NAMES))
+                for _ in range(unique)]
+    return [rand.choice(distinct) for _ in range(size)]
+
+
+def bench_commonpath():
+    paths = manifest(100000)
+    return lambda: commonpath(paths)
+
+
+def bench_commonpath_many():
+    groups = [manifest(1000, seed) for seed in range(100)]
+    return lambda: commonpath_many(groups)
+
+
+def bench_commonpath_accumulator():
+    paths = manifest(100000)
+    return lambda: CommonPathAccumulator(paths, flavor='posix').result()
+
+
+def bench_path_trie():
+    paths = manifest(100000)
+    return lambda: PathTrie(paths, flavor='posix').group(3)
+
+
+def bench_get_safe_path():
+    names = file_names(10000, 10000)
+    return lambda: [get_safe_path(name) for name in names]
+
+
+def bench_get_safe_paths_repeating():
+    names = file_names(100000, 1000)
+    return lambda: get_safe_paths(names)
+
+
+def bench_as_text():
+    data = '\n'.join(file_names(100000, 100000)).encode('utf-8')
+    return lambda: as_text(data)
+
+
+def bench_listify():
+    args = [[1, 2], (1, 2), set([1, 2]), range(2), 1, 'foo', None] * 10000
+    return lambda: [listify(arg) for arg in args]
+
+
+def bench_run():
+    cmd = [sys.executable, '-c', 'pass']
+    return lambda: [run(cmd) for _ in range(20)]
+
+
+def bench_run_many():
+    cmds = [[sys.executable, '-c', 'print(1)']] * 50
+    return lambda: list(run_many(cmds, stdout=PIPE))
+
+
+# name -> function that sets up the workload, and returns the function to
+# time (called once per round)
+BENCHMARKS = dict((name[len('bench_'):], func)
+                  for name, func in sorted(globals().items())
+                  if name.startswith('bench_'))
+
+
+def run_benchmarks(names, rounds):
+    """Return a dict of benchmark name -> timing stats (in seconds)."""
+    results = {}
+    for name in names:
+        func = BENCHMARKS[name]()
+        func()  # warm up
+        times = timeit.repeat(func, number=1, repeat=rounds)
+        results[name] = {'min': min(times),
+                         'median': statistics.median(times),
+                         'rounds': rounds}
+        print('{0:<30} {1:10.2f} ms {2:10.2f} ms'.format(
+            name, results[name]['min'] * 1000,
+            results[name]['median'] * 1000))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every benchmark vs. the `baseline` results, and
+       return the names of the ones that got slower by more than
+       `threshold` (a fraction)."""
+    regressions = []
+    for name, stats in sorted(results.items()):
+        if name not in baseline:
+            continue
+        change = stats['min'] / baseline[name]['min'] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('{0:<30} {1:+8.1%}{2}'.format(
+            name, change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help='Benchmarks to run (default: all of {0})'
+                        .format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--output', help='Write the results to a JSON file')
+    parser.add_argument('--baseline',
+                        help='Compare with the results in a JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown vs. the baseline that is considered '
+                        'a regression (default: %(default)s)')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    print('{0:<30} {1:>13} {2:>13}'.format('benchmark', 'min', 'median'))
+    results = run_benchmarks(args.names or sorted(BENCHMARKS), args.rounds)
+    if args.output:
+        with open(args.output, 'w') as out_f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'benchmarks': results},
+                      out_f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_f:
+            baseline = json.load(baseline_f)['benchmarks']
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
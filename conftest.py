@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+
+"""pytest configuration"""
+
+
+import sys
+
+
+collect_ignore = []  # pylint: disable=invalid-name
+
+if sys.version_info < (3, 5):
+    # async def syntax
+    collect_ignore.append('ostrich/utils/_aioproc.py')
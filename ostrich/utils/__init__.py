@@ -0,0 +1,45 @@
+"""
+utils package
+
+The most commonly used utility functions are available from the package
+itself (e.g. `ostrich.utils.run`). On Python 3.7+ they are loaded lazily,
+so only the modules that are actually used are imported.
+"""
+
+import importlib
+import sys
+
+
+# public name -> the utils module it comes from
+_LAZY_ATTRS = {
+    'as_text': 'text',
+    'commonpath': 'path',
+    'get_safe_path': 'text',
+    'listify': 'collections',
+    'run': 'proc',
+}
+
+__all__ = sorted(_LAZY_ATTRS)
+
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        """Import the module of the public attribute `name` (PEP 562)."""
+        module = _LAZY_ATTRS.get(name)
+        if module is None:
+            raise AttributeError('module {0!r} has no attribute {1!r}'
+                                 .format(__name__, name))
+        value = getattr(importlib.import_module('.' + module, __name__),
+                        name)
+        globals()[name] = value  # later lookups skip __getattr__
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_LAZY_ATTRS))
+
+else:
+    for _name, _module in _LAZY_ATTRS.items():
+        globals()[_name] = getattr(
+            importlib.import_module('.' + _module, __name__), _name)
+    del _name, _module
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+asyncio proc utils module
+
+An asyncio-native counterpart of `ostrich.utils.proc.run`, using event-loop
+subprocess transports instead of a blocking thread per child.
+
+Python 3.5+ only - use it via `ostrich.utils.proc.run_async`.
+"""
+
+
+import asyncio
+import locale
+
+
+_READ_SIZE = 64 * 1024
+
+
+def _translate_newlines(data, encoding):
+    """Decode `data` the way universal_newlines=True Popen pipes would."""
+    data = data.decode(encoding)
+    return data.replace('\r\n', '\n').replace('\r', '\n')
+
+
+async def _feed(stream, data):
+    """Write `data` to the child's stdin `stream`, and close it."""
+    try:
+        if data:
+            stream.write(data)
+            await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # communicate() ignores EPIPE too - the child doesn't want the input
+        pass
+    finally:
+        stream.close()
+
+
+async def _drain(stream, chunks):
+    """Read everything from a child's output `stream` into `chunks`."""
+    while True:
+        data = await stream.read(_READ_SIZE)
+        if not data:
+            break
+        chunks.append(data)
+
+
+async def run_async(*popenargs, **kwargs):
+    """Run command with arguments and return a `CompletedProcess` instance,
+       without blocking the event loop.
+
+    This is the coroutine version of `ostrich.utils.proc.run()`, with the same
+    `input`, `timeout` and `check` arguments, and the same return value and
+    exceptions (`CalledProcessError` and `TimeoutExpired`).
+
+    The other arguments are passed to `asyncio.create_subprocess_exec()`
+    (or `asyncio.create_subprocess_shell()` if shell=True), which accept most
+    of the Popen constructor arguments.
+
+    If universal_newlines=True is passed, the `input` argument must be a
+    string and stdout/stderr in the returned object will be strings rather
+    than bytes, decoded using the preferred locale encoding.
+
+    If the coroutine is cancelled, the child process is killed.
+    """
+    # imported here, as ostrich.utils.proc imports this module
+    from ostrich.utils.proc import (
+        CalledProcessError, CompletedProcess, PIPE, _TimeoutExpired)
+
+    stdin = kwargs.pop('input', None)
+    timeout = kwargs.pop('timeout', None)
+    check = kwargs.pop('check', False)
+    universal_newlines = kwargs.pop('universal_newlines', False)
+    shell = kwargs.pop('shell', False)
+    if stdin is not None:
+        if 'stdin' in kwargs:
+            raise ValueError('stdin and input arguments may not both be used.')
+        kwargs['stdin'] = PIPE
+    if popenargs:
+        args, = popenargs
+    else:
+        args = kwargs.pop('args')
+    encoding = locale.getpreferredencoding(False)
+    if universal_newlines and stdin is not None:
+        stdin = stdin.encode(encoding)
+
+    if shell:
+        process = await asyncio.create_subprocess_shell(args, **kwargs)
+    else:
+        if isinstance(args, (str, bytes)):
+            args = [args]
+        process = await asyncio.create_subprocess_exec(*args, **kwargs)
+
+    stdout_chunks, stderr_chunks = [], []
+    tasks = [asyncio.ensure_future(process.wait())]
+    if process.stdin is not None:
+        tasks.append(asyncio.ensure_future(_feed(process.stdin, stdin)))
+    if process.stdout is not None:
+        tasks.append(asyncio.ensure_future(
+            _drain(process.stdout, stdout_chunks)))
+    if process.stderr is not None:
+        tasks.append(asyncio.ensure_future(
+            _drain(process.stderr, stderr_chunks)))
+
+    def collect(chunks, stream):
+        """Return the captured output of `stream` (None if not captured)."""
+        if stream is None:
+            return None
+        data = b''.join(chunks)
+        if universal_newlines:
+            return _translate_newlines(data, encoding)
+        return data
+
+    try:
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            process.kill()
+            await asyncio.wait(pending)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        for task in tasks:
+            task.cancel()
+        raise
+    if pending:
+        raise _TimeoutExpired(popenargs, timeout,
+                              output=collect(stdout_chunks, process.stdout),
+                              stderr=collect(stderr_chunks, process.stderr))
+    for task in tasks:
+        # re-raise unexpected exceptions from feeding/draining
+        task.result()
+
+    stdout = collect(stdout_chunks, process.stdout)
+    stderr = collect(stderr_chunks, process.stderr)
+    retcode = process.returncode
+    if check and retcode:
+        raise CalledProcessError(retcode, popenargs,
+                                 output=stdout, stderr=stderr)
+    return CompletedProcess(popenargs, retcode, stdout, stderr)
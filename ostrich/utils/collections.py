@@ -12,12 +12,78 @@ A bunch of collections-related utility functions. Hazza!
 from __future__ import absolute_import
 from __future__ import unicode_literals  # so strings without u'' are unicode
 
+from collections import deque, OrderedDict
+from itertools import islice
+import sys
+import threading
 from types import GeneratorType
 
-# no more xrange for the generator one across Python's,
-# thanks to the "future" library
-from builtins import range  # pylint: disable=redefined-builtin
-import past.builtins
+if sys.version_info[0] < 3:
+    # no more xrange for the generator one across Python's,
+    # thanks to the "future" library
+    from builtins import range  # pylint: disable=redefined-builtin
+    from past.builtins import xrange
+    _RANGE_TYPES = (range, xrange)
+else:
+    _RANGE_TYPES = (range,)
+
+try:
+    from collections.abc import Iterator
+except ImportError:  # Python < 3.3
+    from collections import Iterator
+
+
+def _dict_view_types():
+    """Return a tuple of the dict keys / values / items view types."""
+    sample = {}
+    # Python 2.7 has the views as viewkeys() etc.
+    prefix = 'view' if hasattr(sample, 'viewkeys') else ''
+    return tuple(type(getattr(sample, prefix + name)())
+                 for name in ('keys', 'values', 'items')
+                 if hasattr(sample, prefix + name))
+
+
+# types that listify() converts to a list of their items
+_LISTABLE_TYPES = ((set, frozenset, tuple, deque, GeneratorType, Iterator) +
+                   _RANGE_TYPES + _dict_view_types())
+
+
+def _as_is(args):
+    """Return `args` as is (listify() converter for lists)."""
+    return args
+
+
+def _as_single(args):
+    """Return `args` as the single item of a list (listify() converter for
+       everything that isn't a collection)."""
+    return [args]
+
+
+# exact type -> listify() converter, extended on first use of every
+# built-in type
+_LISTIFY_CONVERTERS = dict.fromkeys(_LISTABLE_TYPES, list)
+_LISTIFY_CONVERTERS.update({list: _as_is, type(None): _as_single,
+                            bool: _as_single, int: _as_single,
+                            str: _as_single, bytes: _as_single})
+
+
+def _listify_converter(args):
+    """Return the listify() converter for the type of `args`."""
+    args_type = type(args)
+    converter = _LISTIFY_CONVERTERS.get(args_type)
+    if converter is None:
+        # subclasses (and types of abstract base classes, like iterators)
+        if isinstance(args, list):
+            converter = _as_is
+        elif isinstance(args, _LISTABLE_TYPES):
+            converter = list
+        else:
+            converter = _as_single
+        if args_type.__module__ in ('builtins', '__builtin__'):
+            # only the (finite) built-in types - caching user classes would
+            # grow the table without bound, and keep dynamic classes alive
+            _LISTIFY_CONVERTERS[args_type] = converter
+    return converter
 
 
 def listify(args):
@@ -38,16 +104,22 @@ def listify(args):
     >>> listify(tuple([1, 2, 3]))
     [1, 2, 3]
 
-    If a generator (also range / xrange) - return as a list.
+    If a frozenset, deque or dict view - return as a list.
 
-    >>> listify(x + 1 for x in range(3))
+    >>> from collections import deque
+    >>> listify(deque([1, 2, 3]))
     [1, 2, 3]
-    >>> from past.builtins import xrange
-    >>> from builtins import range
-    >>> listify(xrange(1, 4))
+    >>> listify({'foo': 1}.values())
+    [1]
+
+    If a generator or iterator (also range / xrange) - return as a list.
+
+    >>> listify(x + 1 for x in range(3))
     [1, 2, 3]
     >>> listify(range(1, 4))
     [1, 2, 3]
+    >>> listify(iter([1, 2, 3]))
+    [1, 2, 3]
 
     If a single instance of something that isn't any of the above - put as a
     single element of the returned list.
@@ -70,10 +142,164 @@ def listify(args):
     []
     """
     if args:
-        if isinstance(args, list):
+        if type(args) is list:  # pylint: disable=unidiomatic-typecheck
             return args
-        elif isinstance(args, (set, tuple, GeneratorType,
-                               range, past.builtins.xrange)):
-            return list(args)
-        return [args]
+        converter = _LISTIFY_CONVERTERS.get(type(args))
+        if converter is None:
+            converter = _listify_converter(args)
+        return converter(args)
     return []
+
+
+def iterify(args):
+    """Return args as an iterator, without materializing it.
+
+    Follows the same rules as `listify`, but lazily - collections, generators
+    and ranges are iterated as is, a single instance of something else is the
+    single item of the iterator, and "empty" args result an empty iterator.
+
+    >>> list(iterify(x + 1 for x in range(3)))
+    [1, 2, 3]
+    >>> list(iterify(1))
+    [1]
+    >>> list(iterify(None))
+    []
+
+    Unlike `listify`, a list is not returned as is.
+
+    >>> args = [1, 2, 3]
+    >>> iterify(args) is args
+    False
+    """
+    if args:
+        if _listify_converter(args) is _as_single:
+            return iter([args])
+        return iter(args)
+    return iter([])
+
+
+def chunked(iterable, size):
+    """Return an iterator of lists of (up to) `size` consecutive items of
+       `iterable`.
+
+    >>> list(chunked(range(7), 3))
+    [[0, 1, 2], [3, 4, 5], [6]]
+
+    The iterable is consumed lazily, so only a single chunk is held in
+    memory at a time.
+    """
+    if size < 1:
+        raise ValueError('size must be positive, got {0!r}'.format(size))
+    return _chunks(iter(iterable), size)
+
+
+def _chunks(iterator, size):
+    """Yield lists of `size` items of `iterator` (see `chunked`)."""
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def batched_listify(args, size):
+    """Return an iterator of `args` (normalized as in `listify`) as lists of
+       up to `size` items.
+
+    >>> list(batched_listify((x * 2 for x in range(5)), 2))
+    [[0, 2], [4, 6], [8]]
+    >>> list(batched_listify('foo', 2))
+    [['foo']]
+    >>> list(batched_listify(None, 2))
+    []
+    """
+    return chunked(iterify(args), size)
+
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """A bounded, thread-safe mapping that evicts the least recently used
+       entries once it holds more than `maxsize` items.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.stats().items())
+    [('hits', 1), ('maxsize', 2), ('misses', 1), ('size', 2)]
+
+    Attributes:
+
+    - maxsize: The maximal number of entries kept (None for unbounded).
+    - hits: Number of `get()` calls that found their key.
+    - misses: Number of `get()` calls that didn't.
+    """
+
+    def __init__(self, maxsize=128):
+        if maxsize is not None and maxsize < 1:
+            raise ValueError('maxsize must be positive, got {0!r}'
+                             .format(maxsize))
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value cached for `key` (marking it as recently used),
+           or `default` if it isn't cached."""
+        with self._lock:
+            value = self._data.pop(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            # re-inserting moves it to the end (OrderedDict.move_to_end is
+            # Python 3 only)
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache `value` for `key`, evicting the least recently used entry
+           if the cache is full."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if self.maxsize is not None and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove `key` from the cache, and return its value
+           (or `default` if it wasn't cached)."""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """Remove all entries, and reset the hit/miss counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dict with the cache hits, misses, size and maxsize."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'maxsize': self.maxsize}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return ('LRUCache(maxsize={0!r}, size={1}, hits={2}, misses={3})'
+                .format(self.maxsize, len(self._data), self.hits,
+                        self.misses))
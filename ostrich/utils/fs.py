@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+fs utils module
+
+Filesystem utilities that operate on whole directory trees.
+"""
+
+
+# Python 2 / Python 3 compatibility fu
+# http://python-future.org/compatible_idioms.html
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals  # so strings without u'' are unicode
+
+import errno
+import os
+import threading
+import time
+
+from ostrich.utils.collections import chunked, LRUCache
+from ostrich.utils.text import get_safe_paths, SafePathAllocator
+
+
+_clock = getattr(time, 'monotonic', time.time)
+_scandir = getattr(os, 'scandir', None)  # Python 3.5+
+_DEFAULT_WORKERS = 8
+_BATCH_SIZE = 1000
+_CACHE_SIZE = 64 * 1024
+
+
+def _thread_map(func, items, max_workers):
+    """Return [func(item) for item in items], calling `func` concurrently
+       in up to `max_workers` threads (`func` should not raise)."""
+    results = [None] * len(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+    indexes = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        """Process items until exhausted."""
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            results[index] = func(items[index])
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _scan(directory):
+    """Return (sorted names, subdirectory names, error) of the entries in
+       `directory` (symlinks to directories are not subdirectories)."""
+    names, subdirs = [], []
+    try:
+        if _scandir is None:
+            for name in os.listdir(directory):
+                names.append(name)
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    subdirs.append(name)
+        else:
+            for entry in _scandir(directory):
+                names.append(entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+    except OSError as exc:
+        return sorted(names), subdirs, exc
+    # sorted, so colliding names get the same suffixes on every run
+    return sorted(names), subdirs, None
+
+
+def _rename(rename):
+    """Perform a (old path, new path) rename, and return the error
+       (None on success).
+
+    An existing entry at the new path (e.g. one that differs only in case,
+    on a case-insensitive filesystem) is never overwritten.
+    """
+    old_path, new_path = rename
+    try:
+        try:
+            new_stat = os.lstat(new_path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        else:
+            # unless it's the same entry, spelled differently
+            if not os.path.samestat(os.lstat(old_path), new_stat):
+                return OSError(errno.EEXIST, os.strerror(errno.EEXIST),
+                               new_path)
+        os.rename(old_path, new_path)
+    except OSError as exc:
+        return exc
+    return None
+
+
+class SanitizeResult(object):
+    """The plan and outcome of `sanitize_tree()`.
+
+    Attributes:
+
+    - plan: List of (old path, new path) renames, in execution order.
+    - errors: List of (path, exception) of entries that couldn't be
+              scanned, named or renamed.
+    - dry_run: True if the renames were only planned.
+    - scanned: Number of entries found in the tree.
+    - renamed: Number of entries that were renamed.
+    - scan_time, plan_time, rename_time: Seconds spent in every phase.
+    """
+
+    def __init__(self, dry_run):
+        self.plan = []
+        self.errors = []
+        self.dry_run = dry_run
+        self.scanned = self.renamed = 0
+        self.scan_time = self.plan_time = self.rename_time = 0.0
+
+    @property
+    def elapsed(self):
+        """Total seconds spent sanitizing the tree."""
+        return self.scan_time + self.plan_time + self.rename_time
+
+    @property
+    def rate(self):
+        """Throughput of the sanitizing, in scanned entries per second."""
+        return self.scanned / self.elapsed if self.elapsed else 0.0
+
+    def format_plan(self):
+        """Return the plan as text, with an "old -> new" line per rename."""
+        return ''.join('{0} -> {1}\n'.format(old, new)
+                       for old, new in self.plan)
+
+    def __repr__(self):
+        return ('SanitizeResult(dry_run={0!r}, scanned={1}, planned={2}, '
+                'renamed={3}, errors={4}, elapsed={5:.3f})'
+                .format(self.dry_run, self.scanned, len(self.plan),
+                        self.renamed, len(self.errors), self.elapsed))
+
+
+def _plan_directory(directory, names, allocator, batch_size, result):
+    """Return a list of (old name, new name) renames that make all `names`
+       in `directory` safe and unique."""
+    unsafe = []
+    for batch in chunked(names, batch_size):
+        try:
+            safe_names = get_safe_paths(batch, allocator.cache)
+        except ValueError:
+            # some name can't be made safe - find which, one by one
+            safe_names = []
+            for name in batch:
+                try:
+                    safe_names.extend(get_safe_paths([name], allocator.cache))
+                except ValueError as exc:
+                    result.errors.append((os.path.join(directory, name), exc))
+                    safe_names.append(None)
+        for name, safe_name in zip(batch, safe_names):
+            if safe_name == name or safe_name is None:
+                # safe names (and ones that are left as is) are never taken
+                allocator.reserve(name, directory)
+            else:
+                unsafe.append(name)
+    renames = []
+    for batch in chunked(unsafe, batch_size):
+        renames.extend(zip(batch, allocator.allocate_many(batch, directory)))
+    return renames
+
+
+def sanitize_tree(root, dry_run=False, max_workers=_DEFAULT_WORKERS,
+                  batch_size=_BATCH_SIZE, case_sensitive=True):
+    """Rename every entry under the `root` directory, so that every path
+       component is a `get_safe_path()` name, and return a `SanitizeResult`.
+
+    The tree is scanned level by level with `max_workers` threads. Names are
+    then converted in batches of `batch_size`, adding suffixes to names that
+    collide in the same directory (see `SafePathAllocator`). Names that are
+    already safe are kept, and case-insensitive collisions are avoided if
+    `case_sensitive` is False.
+
+    The renames are performed bottom-up (a level at a time, with
+    `max_workers` threads), so the paths of parent directories stay valid.
+    If `dry_run` is True, the renames are only planned.
+
+    `root` itself is not renamed, and symlinks are renamed but not followed.
+    Existing entries are never overwritten (e.g. ones that differ only in
+    case on a case-insensitive filesystem) - such renames fail with EEXIST.
+    Errors (e.g. a directory that can't be scanned) are recorded in the
+    result rather than raised.
+
+    :warning: The tree should not be modified by others while it is being
+              sanitized - an entry created right before its rename may still
+              be overwritten.
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers must be greater than 0')
+    result = SanitizeResult(dry_run)
+    allocator = SafePathAllocator(case_sensitive=case_sensitive,
+                                  cache=LRUCache(maxsize=_CACHE_SIZE))
+
+    # scan the tree, a level at a time: [[(directory, names), ...], ...]
+    start_time = _clock()
+    levels = []
+    directories = [root]
+    while directories:
+        level = []
+        subdirectories = []
+        scans = _thread_map(_scan, directories, max_workers)
+        for directory, (names, subdirs, error) in zip(directories, scans):
+            if error is not None:
+                result.errors.append((directory, error))
+            result.scanned += len(names)
+            level.append((directory, names))
+            subdirectories.extend(os.path.join(directory, name)
+                                  for name in subdirs)
+        levels.append(level)
+        directories = subdirectories
+    result.scan_time = _clock() - start_time
+
+    start_time = _clock()
+    level_renames = []
+    for level in levels:
+        renames = []
+        for directory, names in level:
+            renames.extend(
+                (os.path.join(directory, old), os.path.join(directory, new))
+                for old, new in _plan_directory(directory, names, allocator,
+                                                batch_size, result))
+        level_renames.append(renames)
+    result.plan_time = _clock() - start_time
+
+    start_time = _clock()
+    for renames in reversed(level_renames):
+        result.plan.extend(renames)
+        if dry_run:
+            continue
+        errors = _thread_map(_rename, renames, max_workers)
+        for (old_path, _), error in zip(renames, errors):
+            if error is None:
+                result.renamed += 1
+            else:
+                result.errors.append((old_path, error))
+    result.rename_time = _clock() - start_time
+    return result
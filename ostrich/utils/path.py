@@ -12,19 +12,30 @@ path utils module
 from __future__ import absolute_import
 from __future__ import unicode_literals  # so strings without u'' are unicode
 
-# uniform unicode type across Python's
-from builtins import bytes, str  # from "future" library
-
+import ntpath
 import os
+from os.path import commonprefix
+import sys
+
+if sys.version_info[0] < 3:
+    # uniform unicode type across Python's
+    from builtins import bytes, str  # from "future" library
+
+
+# bytes-like types that are accepted (and treated) as bytes
+_BUFFER_TYPES = (bytearray, memoryview)
 
 
 def check_arg_types(funcname, *args):
-    """Raise TypeError if not all items of `args` are same string type."""
+    """Raise TypeError if not all items of `args` are same string type.
+
+    bytearray and memoryview items count as bytes.
+    """
     hasstr = hasbytes = False
     for arg in args:
         if isinstance(arg, str):
             hasstr = True
-        elif isinstance(arg, bytes):
+        elif isinstance(arg, (bytes,) + _BUFFER_TYPES):
             hasbytes = True
         else:
             raise TypeError('{0}() argument must be str or bytes, not {1}'
@@ -33,6 +44,15 @@ def check_arg_types(funcname, *args):
         raise TypeError("Can't mix strings and bytes in path components")
 
 
+def _buffers_as_bytes(paths):
+    """Return `paths`, with bytearray and memoryview items converted to bytes
+       (path operations need actual bytes objects)."""
+    if not any(isinstance(path, _BUFFER_TYPES) for path in paths):
+        return paths
+    return [bytes(path) if isinstance(path, _BUFFER_TYPES) else path
+            for path in paths]
+
+
 def posix_commonpath(paths):
     """Given a sequence of POSIX path names,
        return the longest common sub-path."""
@@ -41,32 +61,96 @@ def posix_commonpath(paths):
         raise ValueError('commonpath() arg is an empty sequence')
 
     check_arg_types('commonpath', *paths)
+    paths = _buffers_as_bytes(paths)
 
     if isinstance(paths[0], bytes):
         sep = b'/'
         curdir = b'.'
+        nul = b'\0'
     else:
         sep = '/'
         curdir = '.'
-
-    split_paths = [path.split(sep) for path in paths]
-
-    try:
-        isabs, = set(p[:1] == sep for p in paths)
-    except ValueError:
-        raise ValueError("Can't mix absolute and relative paths")
-
-    split_paths = [[c for c in s if c and c != curdir] for s in split_paths]
-    s_min = min(split_paths)
-    s_max = max(split_paths)
-    common = s_min
-    for i, run_c in enumerate(s_min):
-        if run_c != s_max[i]:
-            common = s_min[:i]
-            break
-
+        nul = '\0'
+    empty = sep[:0]
+
+    # Instead of splitting all paths to components, work on the paths as
+    # strings, normalizing only paths with empty or "." components (or a
+    # trailing separator). The common path of all paths is then the common
+    # path of the lexicographically smallest and largest (normalized) paths,
+    # with care for the last component (see below).
+    # To avoid a Python loop over all paths in the common case, the paths
+    # are checked at once, NUL-joined (NUL can't be a part of a path).
+    joined = nul + nul.join(paths) + nul
+    isabs = paths[0][:1] == sep
+    if joined.count(nul) == len(paths) + 1:
+        if joined.count(nul + sep) != (len(paths) if isabs else 0):
+            raise ValueError("Can't mix absolute and relative paths")
+        # false positives (e.g. 'foo./bar') merely take the slow path
+        irregular = any(pattern in joined for pattern in (
+            sep + sep, sep + nul, curdir + sep, curdir + nul))
+    else:
+        irregular = True
+    if irregular:
+        paths = _posix_normalized(paths, sep, curdir, isabs)
+    del joined
+
+    s_min = min(paths)
+    s_max = max(paths)
+    if s_min == s_max:
+        return s_min
+    common = commonprefix([s_min, s_max])
+    end = len(common)
+    # The last (possibly partial) component of the common prefix is common
+    # to all paths only if every path ends there, or has a separator there.
+    # Every path starts with the common prefix of the extremes, but a path
+    # between them may continue with a character smaller than the separator
+    # (e.g. '/usr/lib-x' is between '/usr/lib' and '/usr/lib/x').
+    if (end == len(s_min) and s_max[end:end + 1] == sep and
+            all(path[end:end + 1] in (sep, empty) for path in paths)):
+        return common
+    last_sep = common.rfind(sep)
+    if last_sep > 0:
+        return common[:last_sep]
+    return sep if isabs else empty
+
+
+def _posix_normalized(paths, sep, curdir, isabs):
+    """Return a list of the POSIX `paths` without empty or `curdir`
+       components, or raise ValueError if they're not all absolute / relative
+       (according to `isabs`)."""
     prefix = sep if isabs else sep[:0]
-    return prefix + sep.join(common)
+    double_sep = sep + sep
+    curdir_sep = curdir + sep
+    sep_curdir = sep + curdir
+    sep_curdir_sep = sep_curdir + sep
+    normalized = list(paths)
+    for i, path in enumerate(paths):
+        if (path[:1] == sep) != isabs:
+            raise ValueError("Can't mix absolute and relative paths")
+        if (double_sep in path or
+                (path.endswith(sep) and path != sep) or
+                (curdir in path and
+                 (path == curdir or path.startswith(curdir_sep) or
+                  path.endswith(sep_curdir) or sep_curdir_sep in path))):
+            normalized[i] = prefix + sep.join(c for c in path.split(sep)
+                                              if c and c != curdir)
+    return normalized
+
+
+def commonpath_many(groups):
+    """Return a list of the longest common sub-paths of every sequence of
+       path names in `groups` iterable.
+
+    >>> for path in commonpath_many([['foo/bar', 'foo/baz'], ['spam/eggs']]):
+    ...     print(path)
+    foo
+    spam/eggs
+
+    Raise the same errors as commonpath(), for the first failing sequence.
+    """
+    if os.name == 'posix':
+        return [posix_commonpath(paths) for paths in groups]
+    return [nt_commonpath(paths) for paths in groups]
 
 
 def nt_commonpath(paths):  # pylint: disable=too-many-locals
@@ -79,6 +163,7 @@ def nt_commonpath(paths):  # pylint: disable=too-many-locals
         raise ValueError('commonpath() arg is an empty sequence')
 
     check_arg_types('commonpath', *paths)
+    paths = _buffers_as_bytes(paths)
 
     if isinstance(paths[0], bytes):
         sep = b'\\'
@@ -140,3 +225,370 @@ def commonpath(paths):
     if os.name == 'posix':
         return posix_commonpath(paths)
     return nt_commonpath(paths)
+
+
+class _TrieNode(object):
+    """A node of `PathTrie`, representing a path component."""
+
+    __slots__ = ('name', 'children', 'count', 'terminal')
+
+    def __init__(self, name):
+        self.name = name  # spelling of the component in the first path
+        self.children = None  # {component key: node}, None for leaves
+        self.count = 0  # number of paths at or below this node
+        self.terminal = 0  # number of paths ending at this node
+
+
+class PathTrie(object):
+    """A prefix tree of path components, built once from many paths, for fast
+       repeated common-root, subtree count and grouping queries.
+
+    >>> trie = PathTrie(['foo/bar/a', 'foo/bar/b', 'foo/baz/c'],
+    ...                 flavor='posix')
+    >>> print(trie.commonpath())
+    foo
+    >>> trie.count('foo/bar')
+    2
+    >>> sorted(trie.group(2).items()) == [('foo/bar', 2), ('foo/baz', 1)]
+    True
+
+    Paths are split and compared like commonpath() does, according to the
+    `flavor` ('posix' or 'nt', defaults to the current platform) - so with
+    'nt', components are compared case-insensitively, and results use the
+    spelling of the first path added with the component.
+    Like commonpath(), all paths must be of the same type (str or bytes),
+    all absolute or all relative, and (with 'nt') on the same drive -
+    otherwise adding a path raises TypeError or ValueError. Every added path
+    is checked against the first one as it's added, so the ValueError may
+    differ from the one commonpath() raises for all paths (e.g. a path on
+    another drive fails before a relative path that comes after it).
+
+    Components are interned, and nodes use slots, to keep the memory
+    footprint low.
+    """
+
+    def __init__(self, paths=(), flavor=None):
+        if flavor is None:
+            flavor = 'posix' if os.name == 'posix' else 'nt'
+        if flavor not in ('posix', 'nt'):
+            raise ValueError('Unknown path flavor {0!r}'.format(flavor))
+        self.flavor = flavor
+        self._root = _TrieNode(None)
+        self._names = {}
+        self._kind = None  # type of the first path
+        self._isabs = None
+        self._drive = None  # (key, spelling) of the first path's drive
+        self.update(paths)
+
+    def __len__(self):
+        return self._root.count
+
+    def _seps(self, kind=None):
+        """Return the (sep, altsep, curdir) of the trie flavor & type (or
+           `kind` type, if given)."""
+        if issubclass(kind or self._kind, bytes):
+            return (b'/', None, b'.') if self.flavor == 'posix' else \
+                (b'\\', b'/', b'.')
+        return ('/', None, '.') if self.flavor == 'posix' else \
+            ('\\', '/', '.')
+
+    def _split(self, path, funcname='PathTrie'):
+        """Return a tuple (drive, isabs, components) of `path`, where drive
+           and every component are tuples (key, spelling)."""
+        check_arg_types(funcname, path)
+        if isinstance(path, _BUFFER_TYPES):
+            path = bytes(path)
+        if self._kind is not None:
+            check_arg_types(funcname, path, self._kind())
+        sep, altsep, curdir = self._seps(
+            bytes if isinstance(path, bytes) else str)
+        if altsep is None:
+            drive = (sep[:0], sep[:0])
+        else:
+            drive, path = ntpath.splitdrive(path.replace(altsep, sep))
+            drive = (drive.lower(), drive)
+        names = [c for c in path.split(sep) if c and c != curdir]
+        if altsep is None:
+            components = [(c, c) for c in names]
+        else:
+            components = [(c.lower(), c) for c in names]
+        return drive, path[:1] == sep, components
+
+    @staticmethod
+    def _check_root(mixed_abs, mixed_drives):
+        """Raise ValueError if paths don't match the root of the trie (in
+           the order commonpath() checks them)."""
+        if mixed_abs:
+            raise ValueError("Can't mix absolute and relative paths")
+        if mixed_drives:
+            raise ValueError("Paths don't have the same drive")
+
+    def add(self, path):
+        """Add `path` to the trie."""
+        drive, isabs, components = self._split(path)
+        if self._isabs is None:
+            # the first path fixes the root and the type of the trie
+            self._kind = (bytes if isinstance(path, (bytes,) + _BUFFER_TYPES)
+                          else str)
+            self._isabs = isabs
+            self._drive = drive
+        self._check_root(isabs != self._isabs, drive[0] != self._drive[0])
+        names = self._names
+        node = self._root
+        node.count += 1
+        for key, name in components:
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(key)
+            if child is None:
+                key = names.setdefault(key, key)
+                child = node.children[key] = _TrieNode(
+                    names.setdefault(name, name))
+            child.count += 1
+            node = child
+        node.terminal += 1
+
+    def update(self, paths):
+        """Add every path in `paths` iterable to the trie."""
+        for path in paths:
+            self.add(path)
+
+    def _format(self, names):
+        """Return the path of the component `names` (from the root down)."""
+        sep = self._seps()[0]
+        drive = self._drive[1]
+        prefix = drive + sep if self._isabs else drive
+        return prefix + sep.join(names)
+
+    def _find(self, path, funcname):
+        """Return the node of `path` (None if not in the trie)."""
+        drive, isabs, components = self._split(path, funcname)
+        if self._isabs is None or isabs != self._isabs or \
+                drive[0] != self._drive[0]:
+            return None
+        node = self._root
+        for key, _ in components:
+            node = node.children.get(key) if node.children else None
+            if node is None:
+                return None
+        return node
+
+    def commonpath(self, paths=None):
+        """Return the longest common sub-path of all paths in the trie,
+           or of the subset `paths` (iterable of paths) if given.
+
+        Returns the same as commonpath() of the same paths (and flavor), and
+        raises the same errors (though with a subset, paths that are not in
+        the trie raise ValueError if they don't match its root).
+        """
+        if not self._root.count:
+            raise ValueError('commonpath() arg is an empty sequence')
+        common = []
+        if paths is None:
+            node = self._root
+            while node.children and not node.terminal and \
+                    len(node.children) == 1:
+                node, = node.children.values()
+                common.append(node.name)
+            return self._format(common)
+        first = True
+        mixed_abs = mixed_drives = False
+        for path in paths:
+            # the root is checked after all paths, as commonpath() does
+            drive, isabs, components = self._split(path, 'commonpath')
+            mixed_abs = mixed_abs or isabs != self._isabs
+            mixed_drives = mixed_drives or drive[0] != self._drive[0]
+            if first:
+                # spelled as in the first path in the subset, like commonpath
+                common = components
+                first = False
+                continue
+            for i, (key, _) in enumerate(common):
+                if i == len(components) or components[i][0] != key:
+                    del common[i:]
+                    break
+        if first:
+            raise ValueError('commonpath() arg is an empty sequence')
+        self._check_root(mixed_abs, mixed_drives)
+        return self._format(name for _, name in common)
+
+    def count(self, prefix):
+        """Return the number of paths in the trie at or below `prefix`."""
+        node = self._find(prefix, 'count')
+        return 0 if node is None else node.count
+
+    def group(self, depth, prefix=None):
+        """Group the paths in the trie (or below `prefix`) by their top
+           `depth` components.
+
+        Returns a dictionary mapping every group path to the number of paths
+        in the group. Paths with less than `depth` components are their own
+        group.
+        """
+        if prefix is None:
+            start = self._root
+            start_names = []
+        else:
+            start = self._find(prefix, 'group')
+            if start is None:
+                return {}
+            # walk again for the spelling of the prefix components
+            start_names = []
+            node = self._root
+            for key, _ in self._split(prefix)[2]:
+                node = node.children[key]
+                start_names.append(node.name)
+        groups = {}
+        stack = [(start, start_names)]
+        while stack:
+            node, names = stack.pop()
+            if len(names) - len(start_names) >= depth:
+                groups[self._format(names)] = node.count
+                continue
+            if node.terminal:
+                groups[self._format(names)] = node.terminal
+            for child in (node.children or {}).values():
+                stack.append((child, names + [child.name]))
+        return groups
+
+
+class CommonPathAccumulator(object):
+    """Compute the longest common sub-path of paths consumed one at a time.
+
+    Only the common path so far is kept in memory (O(depth) rather than
+    O(number of paths)), so the paths may come from a generator, e.g. a
+    directory walk or a file listing:
+
+    >>> acc = CommonPathAccumulator(flavor='posix')
+    >>> acc.update(path for path in ['foo/bar', 'foo/baz'])
+    >>> acc.add('foo/baaam')
+    >>> print(acc.result())
+    foo
+
+    Accumulators of partial results (e.g. from parallel workers) may be
+    combined with merge().
+
+    The result (and errors) are the same as of commonpath() of all paths
+    (in order), according to the `flavor` ('posix' or 'nt', defaults to the
+    current platform). Errors are raised only by result().
+    """
+
+    def __init__(self, paths=(), flavor=None):
+        if flavor is None:
+            flavor = 'posix' if os.name == 'posix' else 'nt'
+        if flavor not in ('posix', 'nt'):
+            raise ValueError('Unknown path flavor {0!r}'.format(flavor))
+        self.flavor = flavor
+        self.count = 0
+        self._type_error = None
+        self._hasstr = self._hasbytes = False
+        self._hasabs = self._hasrel = False
+        self._drive = None  # (key, spelling) of the first path's drive
+        self._mixed_drives = False
+        self._names = None  # components of the first path
+        self._common = None  # keys of the common components
+        self.update(paths)
+
+    def add(self, path):
+        """Add `path` to the accumulated paths."""
+        self.count += 1
+        if isinstance(path, _BUFFER_TYPES):
+            path = bytes(path)
+        if isinstance(path, str):
+            self._hasstr = True
+        elif isinstance(path, bytes):
+            self._hasbytes = True
+        else:
+            if self._type_error is None:
+                self._type_error = TypeError(
+                    'commonpath() argument must be str or bytes, not {0}'
+                    .format(path.__class__.__name__))
+            return
+        if self._type_error is not None or \
+                (self._hasstr and self._hasbytes):
+            # the result is an error anyway
+            return
+        if isinstance(path, bytes):
+            sep, altsep, curdir = b'/', b'\\', b'.'
+        else:
+            sep, altsep, curdir = '/', '\\', '.'
+        if self.flavor == 'posix':
+            drive = (sep[:0], sep[:0])
+            isabs = path[:1] == sep
+            names = [c for c in path.split(sep) if c and c != curdir]
+            keys = names
+        else:
+            sep, altsep = altsep, sep
+            drive, path = ntpath.splitdrive(path.replace(altsep, sep))
+            drive = (drive.lower(), drive)
+            isabs = path[:1] == sep
+            names = [c for c in path.split(sep) if c and c != curdir]
+            keys = [c.lower() for c in names]
+        if isabs:
+            self._hasabs = True
+        else:
+            self._hasrel = True
+        self._combine(drive, names, keys)
+
+    def _combine(self, drive, names, keys, mixed_drives=False):
+        """Combine the drive and components of a path (or a partial result)
+           with the accumulated ones."""
+        if self._drive is None:
+            # copies - `keys` may be `names`, and merged ones are other's
+            self._drive = drive
+            self._names = list(names)
+            self._common = list(keys)
+        else:
+            if drive[0] != self._drive[0]:
+                self._mixed_drives = True
+            common = self._common
+            for i, key in enumerate(common):
+                if i == len(keys) or keys[i] != key:
+                    del common[i:]
+                    break
+        self._mixed_drives = self._mixed_drives or mixed_drives
+
+    def update(self, paths):
+        """Add every path in `paths` iterable to the accumulated paths."""
+        for path in paths:
+            self.add(path)
+
+    def merge(self, other):
+        """Combine the paths accumulated by `other` CommonPathAccumulator
+           into this one, as if they were added after this one's paths."""
+        if other.flavor != self.flavor:
+            raise ValueError("Can't merge accumulators of different flavors")
+        self.count += other.count
+        if self._type_error is None:
+            self._type_error = other._type_error
+        self._hasstr = self._hasstr or other._hasstr
+        self._hasbytes = self._hasbytes or other._hasbytes
+        self._hasabs = self._hasabs or other._hasabs
+        self._hasrel = self._hasrel or other._hasrel
+        if other._drive is not None and self._type_error is None and \
+                not (self._hasstr and self._hasbytes):
+            self._combine(other._drive, other._names, other._common,
+                          other._mixed_drives)
+
+    def result(self):
+        """Return the longest common sub-path of the accumulated paths.
+
+        Raise the errors that commonpath() would raise for them.
+        """
+        if not self.count:
+            raise ValueError('commonpath() arg is an empty sequence')
+        if self._type_error is not None:
+            raise self._type_error
+        if self._hasstr and self._hasbytes:
+            raise TypeError("Can't mix strings and bytes in path components")
+        if self._hasabs and self._hasrel:
+            raise ValueError("Can't mix absolute and relative paths")
+        if self._mixed_drives:
+            raise ValueError("Paths don't have the same drive")
+        if self._hasbytes:
+            sep = b'/' if self.flavor == 'posix' else b'\\'
+        else:
+            sep = '/' if self.flavor == 'posix' else '\\'
+        drive = self._drive[1]
+        prefix = drive + sep if self._hasabs else drive
+        return prefix + sep.join(self._names[:len(self._common)])
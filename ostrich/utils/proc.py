@@ -16,6 +16,31 @@ source: https://github.com/python/cpython/blob/3.5/Lib/subprocess.py
 from __future__ import absolute_import
 from __future__ import unicode_literals  # so strings without u'' are unicode
 
+import errno
+import functools
+import io
+import math
+import os
+import signal
+import stat
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    # Python 2 without the "future" library aliases
+    import Queue as queue
+
+try:
+    import resource
+except ImportError:
+    # not a POSIX platform - no resource limits
+    resource = None
+
 try:
     # Python 3.2 and above - use builtin subprocess module with timeout support
     import subprocess
@@ -45,6 +70,23 @@ except ImportError:
         class TimeoutExpired(SubprocessError):
             pass
 
+from ostrich.utils.collections import LRUCache
+
+# os.posix_spawn is available in Python 3.8 and above, on POSIX platforms
+__posix_spawn__ = hasattr(os, 'posix_spawn')
+
+# monotonic clock where available (Python 3.3 and above)
+_clock = getattr(time, 'monotonic', time.time)
+
+# rename that overwrites existing files on Windows too (Python 3.3 and above)
+_replace = getattr(os, 'replace', os.rename)
+
+# ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# hooks called with the metrics of every run() - see add_hook()
+_HOOKS = []
+
 
 class CalledProcessError(SubprocessError):
     """This exception is raised when a process run by run() with check=True
@@ -53,14 +95,19 @@ class CalledProcessError(SubprocessError):
     The exit status will be stored in the returncode attribute;
     The cmd (run args) will be stored in the cmd attribute;
     The output will be stored in output / stdout attribute;
-    The stderr will be stored in stderr attribute.
+    The stderr will be stored in stderr attribute;
+    The total sizes of the output streams will be stored in stdout_size and
+    stderr_size attributes, if the output capture was bounded.
     """
-    def __init__(self, returncode, cmd, output=None, stderr=None):
+    def __init__(self, returncode, cmd, output=None, stderr=None,
+                 stdout_size=None, stderr_size=None):
         super(CalledProcessError, self).__init__()
         self.returncode = returncode
         self.cmd = cmd
         self.output = output
         self.stderr = stderr
+        self.stdout_size = stdout_size
+        self.stderr_size = stderr_size
 
     def __str__(self):
         return ("Command '{0}' returned non-zero exit status {1}"
@@ -72,15 +119,40 @@ class CalledProcessError(SubprocessError):
         return self.output
 
 
+class ResourceLimitExceeded(CalledProcessError):
+    """This exception is raised when a process run by run() with `limits` is
+       killed for exceeding one of them.
+
+    In addition to the CalledProcessError attributes, the name of the
+    exceeded limit (see `ResourceLimits`) will be stored in the limit
+    attribute, and the `ProcessMetrics` of the run in the metrics attribute.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, limit, returncode, cmd, output=None, stderr=None,
+                 stdout_size=None, stderr_size=None, metrics=None):
+        super(ResourceLimitExceeded, self).__init__(
+            returncode, cmd, output=output, stderr=stderr,
+            stdout_size=stdout_size, stderr_size=stderr_size)
+        self.limit = limit
+        self.metrics = metrics
+
+    def __str__(self):
+        return ("Command '{0}' was killed for exceeding its {1} limit"
+                .format(self.cmd, self.limit))
+
+
 class _TimeoutExpired(TimeoutExpired):
     """This exception is raised when the timeout expires while waiting for a
        child process."""
-    def __init__(self, cmd, timeout, output=None, stderr=None):
+    def __init__(self, cmd, timeout, output=None, stderr=None,
+                 stdout_size=None, stderr_size=None):
         super(_TimeoutExpired, self).__init__(cmd, timeout)
         self.cmd = cmd
         self.timeout = timeout
         self.output = output
         self.stderr = stderr
+        self.stdout_size = stdout_size
+        self.stderr_size = stderr_size
 
     def __str__(self):
         return ("Command '{0}' timed out after {1} seconds"
@@ -102,13 +174,27 @@ class CompletedProcess(object):
     - returncode: The exit code of the process, negative for signals.
     - stdout: The standard output (None if not captured).
     - stderr: The standard error (None if not captured).
+    - stdout_size: The total size of the standard output, if its capture was
+                   bounded (None otherwise).
+    - stderr_size: The total size of the standard error, if its capture was
+                   bounded (None otherwise).
+    - spawn_backend: The backend used for starting the process
+                     ('popen' or 'posix_spawn').
+    - metrics: The `ProcessMetrics` of the run (None if not measured).
     """
 
-    def __init__(self, args, returncode, stdout=None, stderr=None):
+    # pylint: disable=too-many-arguments
+    def __init__(self, args, returncode, stdout=None, stderr=None,
+                 stdout_size=None, stderr_size=None, spawn_backend='popen',
+                 metrics=None):
         self.args = args
         self.returncode = returncode
         self.stdout = stdout
         self.stderr = stderr
+        self.stdout_size = stdout_size
+        self.stderr_size = stderr_size
+        self.spawn_backend = spawn_backend
+        self.metrics = metrics
 
     def __repr__(self):
         args = ['args={0!r}'.format(self.args),
@@ -117,13 +203,92 @@ class CompletedProcess(object):
             args.append('stdout={0!r}'.format(self.stdout))
         if self.stderr is not None:
             args.append('stderr={0!r}'.format(self.stderr))
+        if self.stdout_size is not None:
+            args.append('stdout_size={0!r}'.format(self.stdout_size))
+        if self.stderr_size is not None:
+            args.append('stderr_size={0!r}'.format(self.stderr_size))
         return "{0}({1})".format(type(self).__name__, ', '.join(args))
 
     def check_returncode(self):
         """Raise CalledProcessError if the exit code is non-zero."""
         if self.returncode:
             raise CalledProcessError(self.returncode, self.args, self.stdout,
-                                     self.stderr)
+                                     self.stderr, self.stdout_size,
+                                     self.stderr_size)
+
+
+class ProcessMetrics(object):
+    """Measurements of a process run by run().
+
+    Attributes (times in seconds):
+
+    - spawn_time: Time spent starting the process.
+    - io_time: Time from then until the output streams of the process were
+               closed (feeding the input and draining the output).
+    - wait_time: Time from then until the process was reaped.
+    - kill_time: Time from killing a timed out process until it was reaped
+                 (None if not killed).
+    - wall_time: Total time, from spawning until reaping the process.
+    - stdout_bytes: Size of the standard output (None if not captured) -
+                    in characters with universal_newlines=True.
+    - stderr_bytes: Size of the standard error (None if not captured) -
+                    in characters with universal_newlines=True.
+    - max_rss: Peak resident set size of the process in bytes.
+    - user_time: CPU time spent by the process in user mode.
+    - system_time: CPU time spent by the process in kernel mode.
+
+    The resource usage attributes (max_rss, user_time and system_time) are
+    collected using `os.wait4()`, and are None where it is not available.
+    """
+
+    _fields = ('spawn_time', 'io_time', 'wait_time', 'kill_time', 'wall_time',
+               'stdout_bytes', 'stderr_bytes', 'max_rss', 'user_time',
+               'system_time')
+
+    def __init__(self, **kwargs):
+        for field in self._fields:
+            setattr(self, field, kwargs.pop(field, None))
+        if kwargs:
+            raise TypeError('Unexpected metrics: {0}'
+                            .format(', '.join(sorted(kwargs))))
+
+    def __repr__(self):
+        return '{0}({1})'.format(
+            type(self).__name__,
+            ', '.join('{0}={1!r}'.format(field, getattr(self, field))
+                      for field in self._fields
+                      if getattr(self, field) is not None))
+
+    def as_dict(self):
+        """Return the metrics as a dictionary (e.g. for exporting)."""
+        return dict((field, getattr(self, field)) for field in self._fields)
+
+
+def add_hook(hook):
+    """Register `hook` to be called after every run().
+
+    The hook is called as hook(args, returncode, metrics) once the process is
+    reaped (also if it timed out, or failed with check=True), where `args` is
+    like the args attribute of CompletedProcess, and `metrics` is a
+    `ProcessMetrics` instance.
+
+    Hooks are called in the thread that called run(), so they should be
+    quick and thread-safe. Exceptions raised by hooks propagate to the caller
+    of run().
+    """
+    if hook not in _HOOKS:
+        _HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    """Unregister a hook registered by add_hook()."""
+    _HOOKS.remove(hook)
+
+
+def _call_hooks(args, returncode, metrics):
+    """Call all registered hooks with the metrics of a run."""
+    for hook in list(_HOOKS):
+        hook(args, returncode, metrics)
 
 
 def run(*popenargs, **kwargs):
@@ -149,39 +314,1737 @@ def run(*popenargs, **kwargs):
     you may not also use the Popen constructor's `stdin` argument, as
     it will be used internally.
 
+    The `input` may also be streamed to the subprocess, instead of being
+    held in memory in full, by passing a file object, an iterable of strings
+    (chunks), or a path (an os.PathLike object, e.g. pathlib.Path) of a file.
+    Regular files are copied to the pipe with `os.sendfile()` where
+    supported. The output is drained concurrently.
+
     The other arguments are the same as for the Popen constructor.
 
     If universal_newlines=True is passed, the `input` argument must be a
     string and stdout/stderr in the returned object will be strings rather than
     bytes.
+
+    Captured output is kept in memory in full by default. Pass `capture_head`
+    and/or `capture_tail` to keep only the first / last that many bytes
+    (characters with universal_newlines=True) of every captured stream.
+    The stdout/stderr attributes (of the returned object, and of raised
+    exceptions) are then the head followed by the tail of the output, and the
+    stdout_size/stderr_size attributes hold the total size of the output.
+
+    Pass spawn_backend='posix_spawn' to start the process with
+    `os.posix_spawn()` instead of fork & exec, which is much faster for parent
+    processes with a large memory footprint. This is used only if supported
+    by the platform (see `__posix_spawn__`) and by the given arguments (args,
+    executable, shell, env, stdin, stdout, stderr, restore_signals and
+    start_new_session), falling back to Popen otherwise. Like in CPython,
+    posix_spawn can't close the inherited file descriptors, so it's used only
+    if close_fds=False is passed explicitly. The spawn_backend attribute of
+    the returned object tells which backend was actually used.
+
+    The metrics attribute of the returned object holds `ProcessMetrics`
+    measurements of the run, which are also passed to the hooks registered
+    with add_hook().
+
+    By default, a timed out process is killed, and its output is drained
+    until it's closed. Pass a `TimeoutPolicy` as `timeout_policy` to
+    terminate it gracefully (along with its own child processes), and bound
+    the time spent draining its output.
+
+    Pass `ResourceLimits` as `limits` to limit the resources the process may
+    use (this forces the Popen backend). If the process is killed for
+    exceeding its CPU time or output size limit, ResourceLimitExceeded is
+    raised (regardless of `check`).
     """
     stdin = kwargs.pop('input', None)
     timeout = kwargs.pop('timeout', None)
     check = kwargs.pop('check', False)
+    capture_head = kwargs.pop('capture_head', None)
+    capture_tail = kwargs.pop('capture_tail', None)
+    spawn_backend = kwargs.pop('spawn_backend', 'popen')
+    if spawn_backend not in ('popen', 'posix_spawn'):
+        raise ValueError('Unknown spawn backend {0!r}'.format(spawn_backend))
+    timeout_policy = kwargs.pop('timeout_policy', None)
+    if timeout_policy is not None and timeout_policy.process_group and \
+            hasattr(os, 'killpg'):
+        kwargs['start_new_session'] = True
+    limits = kwargs.pop('limits', None)
+    output_limit = None
+    if limits is not None:
+        limits.apply(kwargs)
+        output_limit = limits.output_size
     if stdin is not None:
         if 'stdin' in kwargs:
             raise ValueError('stdin and input arguments may not both be used.')
         kwargs['stdin'] = PIPE
 
-    process = Popen(*popenargs, **kwargs)
+    start_time = _clock()
+    if spawn_backend == 'posix_spawn' and _can_posix_spawn(popenargs, kwargs):
+        process = _SpawnedProcess(*popenargs, **kwargs)
+    else:
+        spawn_backend = 'popen'
+        process = Popen(*popenargs, **kwargs)
+    communicator = _Communicator(process, start_time, capture_head,
+                                 capture_tail, output_limit)
     try:
         if __timeout__:
-            stdout, stderr = process.communicate(stdin, timeout=timeout)
+            stdout, stderr = communicator.communicate(stdin, timeout=timeout)
         else:
-            stdout, stderr = process.communicate(stdin)
+            stdout, stderr = communicator.communicate(stdin)
     except TimeoutExpired:
         # this will never happen if __timeout__ is False
-        process.kill()
-        stdout, stderr = process.communicate()
+        if timeout_policy is None:
+            process.kill()
+            communicator.kill_time = _clock()
+            stdout, stderr = communicator.communicate()
+        else:
+            stdout, stderr = communicator.escalate(timeout_policy)
+        _call_hooks(popenargs, process.returncode, communicator.metrics())
         # pylint: disable=no-member
         raise _TimeoutExpired(process.args, timeout, output=stdout,
-                              stderr=stderr)
+                              stderr=stderr, **communicator.output_sizes())
     except:
         process.kill()
         process.wait()
         raise
     retcode = process.poll()
+    metrics = communicator.metrics()
+    _call_hooks(popenargs, retcode, metrics)
+    exceeded = None
+    if communicator.output_exceeded:
+        exceeded = 'output_size'
+    elif limits is not None:
+        exceeded = limits.exceeded(retcode, metrics)
+    if exceeded is not None:
+        raise ResourceLimitExceeded(exceeded, retcode, popenargs,
+                                    output=stdout, stderr=stderr,
+                                    metrics=metrics,
+                                    **communicator.output_sizes())
     if check and retcode:
         raise CalledProcessError(retcode, popenargs,
-                                 output=stdout, stderr=stderr)
-    return CompletedProcess(popenargs, retcode, stdout, stderr)
+                                 output=stdout, stderr=stderr,
+                                 **communicator.output_sizes())
+    return CompletedProcess(popenargs, retcode, stdout, stderr,
+                            spawn_backend=spawn_backend, metrics=metrics,
+                            **communicator.output_sizes())
+
+
+_READ_SIZE = 64 * 1024
+_SENDFILE_SIZE = 1024 * 1024
+
+
+class _PipeReader(threading.Thread):
+    """A thread that reads a child's output pipe until EOF, passing the data
+       to the `sink` callable, and finally calling `sink` with None.
+
+    Reads lines (of up to `size` characters) if `lines` is True, or if the
+    pipe is a text pipe (universal_newlines=True), and chunks of up to `size`
+    bytes otherwise.
+    Errors while reading are stored in the `error` attribute.
+    """
+
+    def __init__(self, pipe, sink, lines=False, size=_READ_SIZE):
+        super(_PipeReader, self).__init__()
+        self.daemon = True
+        self.pipe = pipe
+        self.sink = sink
+        self.lines = lines or isinstance(pipe, io.TextIOBase)
+        self.size = size
+        self.error = None
+
+    def run(self):
+        if self.lines:
+            read = functools.partial(self.pipe.readline, self.size)
+        else:
+            read = functools.partial(os.read, self.pipe.fileno(), self.size)
+        try:
+            while True:
+                data = read()
+                if not data:
+                    break
+                self.sink(data)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.error = exc
+        finally:
+            self.pipe.close()
+            self.sink(None)
+
+
+# input types that are written as is (type('') is the text type, due to
+# unicode_literals)
+_STRING_TYPES = (bytes, bytearray, memoryview, type(''))
+
+# errors of os.sendfile() for unsupported file types (e.g. non-socket output
+# on macOS)
+_SENDFILE_UNSUPPORTED = frozenset(
+    getattr(errno, name) for name in ('EINVAL', 'ENOSYS', 'ENOTSOCK',
+                                      'EOPNOTSUPP', 'ENOTSUP')
+    if hasattr(errno, name))
+
+
+class _PipeWriter(threading.Thread):
+    """A thread that writes `data` to a child's input pipe, and closes it.
+
+    `data` is None (nothing to write), a string, a file object, an iterable
+    of strings, or a path (os.PathLike) of a file. The non-string ones are
+    streamed to the pipe, so writing blocks while the pipe is full, and only
+    a chunk at a time is held in memory.
+
+    Like Popen.communicate(), a child that exits without reading all of its
+    input is not considered an error.
+    Other errors while writing (or while reading `data`) are stored in the
+    `error` attribute.
+    """
+
+    def __init__(self, pipe, data):
+        super(_PipeWriter, self).__init__()
+        self.daemon = True
+        self.pipe = pipe
+        self.data = data
+        self.error = None
+
+    def run(self):
+        try:
+            data = self.data
+            if data is None:
+                pass  # nothing to write, just close the pipe
+            elif isinstance(data, _STRING_TYPES):
+                if data:
+                    self.pipe.write(data)
+            elif hasattr(data, '__fspath__'):
+                with open(data.__fspath__(), 'rb') as data_f:
+                    self._write_file(data_f)
+            elif hasattr(data, 'read'):
+                self._write_file(data)
+            else:
+                for chunk in data:
+                    self.pipe.write(chunk)
+        except (IOError, OSError) as exc:
+            if exc.errno not in (errno.EPIPE, errno.EINVAL):
+                self.error = exc
+        except Exception as exc:  # pylint: disable=broad-except
+            self.error = exc
+        finally:
+            try:
+                self.pipe.close()
+            except (IOError, OSError):
+                pass
+
+    def _write_file(self, data_f):
+        """Write the rest of the `data_f` file object to the pipe."""
+        if not self._sendfile(data_f):
+            while True:
+                chunk = data_f.read(_READ_SIZE)
+                if not chunk:
+                    break
+                self.pipe.write(chunk)
+
+    def _sendfile(self, data_f):
+        """Copy the rest of the `data_f` file to the pipe in the kernel, and
+           return True, or return False if it isn't possible."""
+        if not hasattr(os, 'sendfile') or \
+                isinstance(self.pipe, io.TextIOBase):
+            return False
+        try:
+            in_fd = data_f.fileno()
+            if not stat.S_ISREG(os.fstat(in_fd).st_mode):
+                return False
+            offset = data_f.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            # not a real file (e.g. io.BytesIO)
+            return False
+        out_fd = self.pipe.fileno()
+        start = offset
+        try:
+            while True:
+                sent = os.sendfile(out_fd, in_fd, offset, _SENDFILE_SIZE)
+                if not sent:
+                    break
+                offset += sent
+        except OSError as exc:
+            if offset == start and exc.errno in _SENDFILE_UNSUPPORTED:
+                return False
+            raise
+        finally:
+            data_f.seek(offset)
+        return True
+
+
+class _HeadTailBuffer(object):
+    """A sink that keeps the first `head` and last `tail` items (bytes or
+       characters) of the data passed to it, counting the total size.
+
+    With head=None, all of the data is kept.
+
+    The tail is kept as a queue of chunks, trimmed as data is added, so memory
+    use is bounded by head + tail + a single chunk.
+    """
+
+    def __init__(self, head, tail, empty=b''):
+        self.empty = empty
+        self.head_size = head
+        self.tail_size = tail
+        self.size = 0
+        self._head = []
+        self._head_len = 0
+        self._tail = deque()
+        self._tail_len = 0
+
+    def __call__(self, data):
+        if data is None:
+            return
+        self.size += len(data)
+        if self.head_size is None:
+            self._head.append(data)
+            return
+        if self._head_len < self.head_size:
+            chunk = data[:self.head_size - self._head_len]
+            self._head.append(chunk)
+            self._head_len += len(chunk)
+            data = data[len(chunk):]
+        if data and self.tail_size:
+            self._tail.append(data)
+            self._tail_len += len(data)
+            while self._tail_len - len(self._tail[0]) >= self.tail_size:
+                self._tail_len -= len(self._tail.popleft())
+
+    def getvalue(self):
+        """Return the head followed by the tail of the data."""
+        if self.head_size is None:
+            return self.empty.join(self._head)
+        tail = self.empty.join(self._tail)
+        if len(tail) > self.tail_size:
+            tail = tail[len(tail) - self.tail_size:]
+        return self.empty.join(self._head) + tail
+
+
+class _Communicator(object):
+    """Communicate with a child process using helper threads, measuring it.
+
+    If `head` and/or `tail` are set, only the head and tail of every captured
+    output stream are kept.
+
+    Its communicate() method is a drop-in replacement of Popen.communicate(),
+    that reaps the child using `os.wait4()` where available, to collect its
+    resource usage.
+
+    The time attributes are _clock() times - `start_time` is the time before
+    spawning the process, and `kill_time` should be set by whoever kills it.
+
+    If `output_limit` is set, the process is killed once it writes more than
+    that to any captured output stream (and output_exceeded is set).
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, process, start_time, head=None, tail=None,
+                 output_limit=None):
+        self.process = process
+        self.output_limit = output_limit
+        self.output_exceeded = False
+        self.bounded = head is not None or tail is not None
+        if self.bounded:
+            head, tail = head or 0, tail or 0
+        self.stdout = self.stderr = None
+        if process.stdout is not None:
+            self.stdout = _HeadTailBuffer(head, tail, _empty(process.stdout))
+        if process.stderr is not None:
+            self.stderr = _HeadTailBuffer(head, tail, _empty(process.stderr))
+        self.start_time = start_time
+        self.spawn_time = _clock()
+        self.io_time = self.wait_time = self.kill_time = None
+        self.rusage = None
+        self._threads = None
+
+    def _start(self, stdin):
+        """Start the helper threads."""
+        process = self.process
+        self._threads = []
+        if process.stdin is not None:
+            self._threads.append(_PipeWriter(process.stdin, stdin))
+        if process.stdout is not None:
+            self._threads.append(_PipeReader(process.stdout,
+                                             self._limited(self.stdout)))
+        if process.stderr is not None:
+            self._threads.append(_PipeReader(process.stderr,
+                                             self._limited(self.stderr)))
+        for thread in self._threads:
+            thread.start()
+
+    def _limited(self, sink):
+        """Return `sink`, or a sink that passes up to `output_limit` of the
+           data to it, and kills the process if it writes more."""
+        if self.output_limit is None:
+            return sink
+        remaining = [self.output_limit]
+
+        def limited_sink(data):
+            """Pass `data` to the sink, up to the limit."""
+            if data is not None and len(data) > remaining[0]:
+                data = data[:remaining[0]]
+                if not self.output_exceeded:
+                    self.output_exceeded = True
+                    self.kill_time = _clock()
+                    _send_signal(self.process, None)
+            if data is None or data:
+                remaining[0] -= len(data or '')
+                sink(data)
+
+        return limited_sink
+
+    def communicate(self, stdin=None, timeout=None):
+        """Send `stdin` to the child (on first call), and wait for it to close
+           its output and terminate.
+
+        Raise TimeoutExpired if `timeout` expires first. Like Popen's, it may
+        be called again, to finish the communication (e.g. after a kill).
+
+        Returns a tuple (stdout, stderr) of the captured head and tail.
+        """
+        if self._threads is None:
+            self._start(stdin)
+        deadline = None if timeout is None else _clock() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - _clock()))
+            if thread.is_alive():
+                raise TimeoutExpired(self.process.args, timeout)
+        if self.io_time is None:
+            self.io_time = _clock()
+        self._reap(None if deadline is None else max(0, deadline - _clock()))
+        for thread in self._threads:
+            if thread.error is not None:
+                raise thread.error
+        return self._values()
+
+    def _reap(self, timeout=None):
+        """Reap the process (if not reaped already), collecting its resource
+           usage, or raise TimeoutExpired if `timeout` expires first."""
+        if self.wait_time is None:
+            self.rusage = _reap(self.process, timeout)
+            self.wait_time = _clock()
+
+    def _values(self):
+        """Return a tuple (stdout, stderr) of the captured output."""
+        return tuple(None if sink is None else sink.getvalue()
+                     for sink in (self.stdout, self.stderr))
+
+    def escalate(self, policy):
+        """Terminate a timed out process according to `policy`, and return
+           whatever was captured until then (like communicate()).
+
+        The process (or its process group) is sent `policy.term_signal`, and
+        is killed after `policy.grace_period` seconds. Then the output is
+        drained for up to `policy.drain_timeout` seconds.
+        """
+        self.kill_time = _clock()
+        group = policy.process_group
+        _send_signal(self.process, policy.term_signal, group)
+        try:
+            self._reap(policy.grace_period)
+        except TimeoutExpired:
+            pass
+        # killing the group also if the leader terminated, to get rid of
+        # any child processes that ignored the termination signal
+        _send_signal(self.process, None, group)
+        self._reap()
+        deadline = (None if policy.drain_timeout is None
+                    else _clock() + policy.drain_timeout)
+        for thread in self._threads or ():
+            thread.join(None if deadline is None
+                        else max(0, deadline - _clock()))
+        if self.io_time is None:
+            self.io_time = _clock()
+        return self._values()
+
+    def output_sizes(self):
+        """Return the output size keyword arguments for CompletedProcess and
+           the exceptions (empty if the output capture is unbounded)."""
+        if not self.bounded:
+            return {}
+        return dict(stdout_size=None if self.stdout is None
+                    else self.stdout.size,
+                    stderr_size=None if self.stderr is None
+                    else self.stderr.size)
+
+    def metrics(self):
+        """Return the `ProcessMetrics` of a terminated process."""
+        metrics = ProcessMetrics()
+        metrics.spawn_time = self.spawn_time - self.start_time
+        metrics.io_time = self.io_time - self.spawn_time
+        metrics.wait_time = self.wait_time - self.io_time
+        if self.kill_time is not None:
+            metrics.kill_time = self.wait_time - self.kill_time
+        metrics.wall_time = self.wait_time - self.start_time
+        if self.stdout is not None:
+            metrics.stdout_bytes = self.stdout.size
+        if self.stderr is not None:
+            metrics.stderr_bytes = self.stderr.size
+        if self.rusage is not None:
+            metrics.max_rss = self.rusage.ru_maxrss * _RSS_UNIT
+            metrics.user_time = self.rusage.ru_utime
+            metrics.system_time = self.rusage.ru_stime
+        return metrics
+
+
+def _empty(pipe):
+    """Return the empty string of the type read from `pipe`."""
+    return '' if isinstance(pipe, io.TextIOBase) else b''
+
+
+class TimeoutPolicy(object):
+    """How run() terminates a process that timed out.
+
+    Attributes:
+
+    - grace_period: Seconds to wait for the process to exit after sending it
+                    `term_signal`, before killing it (default 5).
+    - drain_timeout: Maximal seconds to spend reading the remaining output of
+                     the process once it's killed (default 1, None for
+                     unbounded). Output that was not read in time is lost.
+    - process_group: If True (default), the process is started in a new
+                     session (start_new_session=True), and the signals are
+                     sent to its entire process group, so that its own child
+                     processes are terminated too (POSIX only).
+    - term_signal: The signal sent first (default SIGTERM).
+    """
+
+    def __init__(self, grace_period=5.0, drain_timeout=1.0,
+                 process_group=True, term_signal=signal.SIGTERM):
+        self.grace_period = grace_period
+        self.drain_timeout = drain_timeout
+        self.process_group = process_group
+        self.term_signal = term_signal
+
+
+class ResourceLimits(object):
+    """Resource limits of a process run by run().
+
+    The address space, CPU time and open files limits are applied in the
+    child process with `resource.setrlimit()` (POSIX only), and can't exceed
+    the hard limits of the parent. A process that exceeds its address space
+    or open files limit isn't killed - its allocations or opening of files
+    fail, which it typically handles by exiting with an error.
+
+    Attributes (None for no limit):
+
+    - address_space: Maximal size of the virtual memory of the process, in
+                     bytes (RLIMIT_AS).
+    - cpu_time: Maximal CPU time of the process, in seconds (RLIMIT_CPU).
+                The process gets SIGXCPU when it's exceeded, and is killed a
+                second later if it's still running.
+    - open_files: Maximal number of open file descriptors (RLIMIT_NOFILE).
+    - output_size: Maximal size of every captured output stream, in bytes
+                   (characters with universal_newlines=True). The process is
+                   killed once it writes more, and the captured output is
+                   truncated at the limit.
+    """
+
+    _RLIMITS = (('address_space', 'RLIMIT_AS'), ('cpu_time', 'RLIMIT_CPU'),
+                ('open_files', 'RLIMIT_NOFILE'))
+
+    def __init__(self, address_space=None, cpu_time=None, open_files=None,
+                 output_size=None):
+        self.address_space = address_space
+        self.cpu_time = cpu_time
+        self.open_files = open_files
+        self.output_size = output_size
+
+    def __repr__(self):
+        return '{0}({1})'.format(
+            type(self).__name__,
+            ', '.join('{0}={1!r}'.format(name, getattr(self, name))
+                      for name in ('address_space', 'cpu_time', 'open_files',
+                                   'output_size')))
+
+    def _rlimits(self):
+        """Return a list of (resource, (soft, hard)) limits to set."""
+        rlimits = []
+        for name, rlimit_name in self._RLIMITS:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if resource is None or not hasattr(resource, rlimit_name):
+                raise ValueError('The {0} limit is not supported on this '
+                                 'platform'.format(name))
+            rlimit = getattr(resource, rlimit_name)
+            _, hard = resource.getrlimit(rlimit)
+            soft = int(math.ceil(value))
+            if name == 'cpu_time':
+                # SIGXCPU on the soft limit, SIGKILL a second later
+                new_hard = soft + 1
+            else:
+                new_hard = soft
+            if hard != resource.RLIM_INFINITY:
+                soft, new_hard = min(soft, hard), min(new_hard, hard)
+            rlimits.append((rlimit, (soft, new_hard)))
+        return rlimits
+
+    def apply(self, kwargs):
+        """Add a preexec_fn to the Popen `kwargs`, that sets the limits in the
+           child (after calling the given preexec_fn, if any)."""
+        rlimits = self._rlimits()
+        if not rlimits:
+            return
+        preexec_fn = kwargs.get('preexec_fn')
+
+        def set_limits():
+            """Set the resource limits of the child."""
+            if preexec_fn is not None:
+                preexec_fn()
+            for rlimit, limits in rlimits:
+                resource.setrlimit(rlimit, limits)
+
+        kwargs['preexec_fn'] = set_limits
+
+    def exceeded(self, returncode, metrics):
+        """Return the name of the limit that killed a process, given its
+           return code and metrics (None if it wasn't killed by a limit)."""
+        if self.cpu_time is None or returncode is None or returncode >= 0:
+            return None
+        if returncode == -getattr(signal, 'SIGXCPU', 0):
+            return 'cpu_time'
+        if returncode == -signal.SIGKILL and metrics.user_time is not None \
+                and metrics.user_time + metrics.system_time >= self.cpu_time:
+            return 'cpu_time'
+        return None
+
+
+def _send_signal(process, sig, group=False):
+    """Send the signal `sig` (None for killing) to `process`, or to its
+       entire process group, if `group` is set and supported."""
+    if group and hasattr(os, 'killpg'):
+        try:
+            os.killpg(process.pid, signal.SIGKILL if sig is None else sig)
+        except OSError as exc:
+            # ESRCH - no such group, or EPERM - a zombie group leader (macOS)
+            if exc.errno not in (errno.ESRCH, errno.EPERM):
+                raise
+    elif process.returncode is None and hasattr(os, 'wait4'):
+        # not Popen.kill() - it polls the process first, which may reap it
+        # (e.g. from a reader thread) before `_reap()`, losing its rusage
+        try:
+            os.kill(process.pid, signal.SIGKILL if sig is None else sig)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+    elif process.returncode is None:
+        if sig is None:
+            process.kill()
+        else:
+            process.send_signal(sig)
+
+
+def _wait4(pid, timeout, args):
+    """Wait for the child `pid` to terminate, using `os.wait4()`.
+
+    Return a tuple (status, rusage), or raise TimeoutExpired (with `args`)
+    if `timeout` expires first.
+    """
+    if timeout is None:
+        _, status, rusage = os.wait4(pid, 0)
+        return status, rusage
+    deadline = _clock() + timeout
+    delay = 0.0005
+    while True:
+        waited_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if waited_pid == pid:
+            return status, rusage
+        remaining = deadline - _clock()
+        if remaining <= 0:
+            raise TimeoutExpired(args, timeout)
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+
+def _reap(process, timeout=None):
+    """Wait for `process` to terminate (setting its returncode), and return
+       its resource usage (None if not available).
+
+    Raise TimeoutExpired if `timeout` expires first.
+    """
+    if process.returncode is not None or not hasattr(os, 'wait4'):
+        if timeout is None:
+            process.wait()
+        else:
+            process.wait(timeout=timeout)
+        return None
+    try:
+        status, rusage = _wait4(process.pid, timeout, process.args)
+    except OSError as exc:
+        if exc.errno != errno.ECHILD:
+            raise
+        # the child was reaped elsewhere (e.g. SIGCHLD is ignored)
+        process.returncode = 0
+        return None
+    process.returncode = _exitcode(status)
+    return rusage
+
+
+def _can_posix_spawn(popenargs, kwargs):
+    """Return True if the Popen arguments are supported by _SpawnedProcess
+       (which can't close the inherited fds, so only with close_fds=False)."""
+    supported = ('args', 'executable', 'shell', 'env', 'stdin', 'stdout',
+                 'stderr', 'close_fds', 'restore_signals', 'start_new_session')
+    streams = (None, PIPE, subprocess.STDOUT, getattr(subprocess, 'DEVNULL',
+                                                      None))
+    return (__posix_spawn__ and
+            kwargs.get('close_fds') is False and
+            len(popenargs) + ('args' in kwargs) == 1 and
+            all(key in supported for key in kwargs) and
+            all(stream in streams or isinstance(stream, int) or
+                hasattr(stream, 'fileno')
+                for stream in (kwargs.get('stdin'), kwargs.get('stdout'),
+                               kwargs.get('stderr'))))
+
+
+def _exitcode(status):
+    """Return a Popen-like return code, given a wait() status."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class _SpawnedProcess(object):
+    """A child process started using `os.posix_spawn()`.
+
+    Implements the subset of the Popen interface that `_Communicator` needs,
+    for the subset of Popen arguments allowed by `_can_posix_spawn()`.
+    """
+
+    # pylint: disable=too-many-arguments, too-many-locals, unused-argument
+    def __init__(self, args, executable=None, shell=False, env=None,
+                 stdin=None, stdout=None, stderr=None, close_fds=False,
+                 restore_signals=True, start_new_session=False):
+        self.args = args
+        self.returncode = None
+        if isinstance(args, (str, bytes)):
+            args = [args]
+        else:
+            args = list(args)
+        if shell:
+            args = ['/bin/sh', '-c'] + args
+            if executable:
+                args[0] = executable
+        program = executable or args[0]
+        if os.path.dirname(program) == '':
+            import shutil  # imported here, to keep the import of proc fast
+            path = os.pathsep.join(os.get_exec_path(env))
+            program = shutil.which(program, path=path)
+            if program is None:
+                raise OSError(errno.ENOENT, 'No such file or directory',
+                              args[0])
+        file_actions = []
+        child_fds = []
+        parent_fds = []
+        try:
+            for fileno, stream in ((0, stdin), (1, stdout), (2, stderr)):
+                parent_fds.append(
+                    self._redirect(fileno, stream, file_actions, child_fds))
+            sigdef = ()
+            if restore_signals:
+                sigdef = [getattr(signal, name)
+                          for name in ('SIGPIPE', 'SIGXFSZ')
+                          if hasattr(signal, name)]
+            self.pid = os.posix_spawn(
+                program, args, os.environ if env is None else env,
+                file_actions=file_actions, setsid=start_new_session,
+                setsigdef=sigdef)
+        except:
+            for fileno in parent_fds:
+                if fileno is not None:
+                    os.close(fileno)
+            raise
+        finally:
+            for fileno in child_fds:
+                os.close(fileno)
+        self.stdin, self.stdout, self.stderr = [
+            None if fileno is None else io.open(fileno, mode)
+            for fileno, mode in zip(parent_fds, ('wb', 'rb', 'rb'))]
+
+    @staticmethod
+    def _redirect(fileno, stream, file_actions, child_fds):
+        """Add the file action redirecting the child's standard stream
+           `fileno` to `stream`, returning the parent's end fd for a PIPE."""
+        if stream is None:
+            return None
+        if stream == PIPE:
+            read_fd, write_fd = os.pipe()
+            child_fd, parent_fd = ((read_fd, write_fd) if fileno == 0
+                                   else (write_fd, read_fd))
+            child_fds.append(child_fd)
+            file_actions.append((os.POSIX_SPAWN_DUP2, child_fd, fileno))
+            return parent_fd
+        if stream == subprocess.STDOUT:
+            file_actions.append((os.POSIX_SPAWN_DUP2, 1, fileno))
+        elif stream == getattr(subprocess, 'DEVNULL', None):
+            file_actions.append((os.POSIX_SPAWN_OPEN, fileno, os.devnull,
+                                 os.O_RDONLY if fileno == 0 else os.O_WRONLY,
+                                 0))
+        else:
+            if not isinstance(stream, int):
+                stream = stream.fileno()
+            file_actions.append((os.POSIX_SPAWN_DUP2, stream, fileno))
+        return None
+
+    def poll(self):
+        """Return the return code if the process terminated, None if not."""
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid == self.pid:
+                self.returncode = _exitcode(status)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait for the process to terminate, and return its return code.
+
+        Raise TimeoutExpired if `timeout` expires first.
+        """
+        if self.returncode is None:
+            status, _ = _wait4(self.pid, timeout, self.args)
+            self.returncode = _exitcode(status)
+        return self.returncode
+
+    def send_signal(self, sig):
+        """Send the signal `sig` to the process (if still running)."""
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        """Terminate the process with SIGTERM."""
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        """Kill the process with SIGKILL."""
+        self.send_signal(signal.SIGKILL)
+
+
+class ProcessStream(object):
+    """A running process with streamed (rather than captured) output.
+
+    This is returned by stream().
+
+    Iterating over the instance yields (name, data) tuples as soon as data
+    is read from the child, where name is 'stdout' or 'stderr', and data is a
+    line (or a chunk, with lines=False) of the respective stream.
+    Once all output is consumed, the process is waited for, and the
+    `completed` attribute holds a `CompletedProcess` with its return code.
+
+    Use it as a context manager, or call close(), to kill the process if the
+    iteration is abandoned half way.
+
+    Attributes:
+
+    - args: The list or str args passed to stream().
+    - process: The underlying Popen instance.
+    - completed: A `CompletedProcess` (with stdout and stderr set to None),
+                 once all output is consumed (None before).
+    """
+
+    def __init__(self, popenargs, process, stdin=None, timeout=None,
+                 check=False, lines=True, chunk_size=_READ_SIZE,
+                 max_pending=16):
+        self.args = popenargs
+        self.process = process
+        self.completed = None
+        self._timeout = timeout
+        self._deadline = None if timeout is None else _clock() + timeout
+        self._check = check
+        self._closed = False
+        self._queue = queue.Queue(max_pending)
+        self._threads = []
+        if process.stdin is not None:
+            self._threads.append(_PipeWriter(process.stdin, stdin))
+        self._readers = [
+            _PipeReader(pipe, self._sink(name), lines, chunk_size)
+            for name, pipe in (('stdout', process.stdout),
+                               ('stderr', process.stderr))
+            if pipe is not None]
+        self._threads.extend(self._readers)
+        for thread in self._threads:
+            thread.start()
+
+    def _sink(self, name):
+        """Return a sink that queues data read from the `name` stream."""
+        def sink(data):
+            """Queue data (blocks while the queue is full)."""
+            if not self._closed:
+                self._queue.put((name, data))
+        return sink
+
+    def _remaining(self):
+        """Return time remaining until the deadline (None if no timeout)."""
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - _clock())
+
+    def __iter__(self):
+        running = len(self._readers)
+        while running:
+            # checked before every get, as get() returns queued data even
+            # with a zero timeout (with a child that keeps writing)
+            remaining = self._remaining()
+            try:
+                if remaining == 0:
+                    raise queue.Empty
+                name, data = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                self.close()
+                raise _TimeoutExpired(self.args, self._timeout)
+            if data is None:
+                running -= 1
+            else:
+                yield name, data
+        for thread in self._threads:
+            if thread.error is not None:
+                self.close()
+                raise thread.error
+        try:
+            if __timeout__:
+                retcode = self.process.wait(timeout=self._remaining())
+            else:
+                retcode = self.process.wait()
+        except TimeoutExpired:
+            self.close()
+            raise _TimeoutExpired(self.args, self._timeout)
+        self.completed = CompletedProcess(self.args, retcode)
+        if self._check:
+            self.completed.check_returncode()
+
+    def close(self):
+        """Kill the process (if still running) and discard pending output."""
+        self._closed = True
+        if self.process.poll() is None:
+            self.process.kill()
+        # unblock readers waiting on a full queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.completed is None:
+            self.close()
+
+
+def stream(*popenargs, **kwargs):
+    """Run command with arguments and return a `ProcessStream` instance,
+       for iterating over its output while it runs.
+
+    Unlike run(), the output is not accumulated in memory, so the memory use
+    is constant regardless of the output size - at most `max_pending`
+    lines / chunks are buffered (default 16), and the child blocks on
+    writing when the consumer falls behind.
+
+    >>> import sys
+    >>> with stream([sys.executable, '-c', 'print("BDFL")']) as proc:
+    ...     print(list(proc))
+    [('stdout', b'BDFL\\n')]
+    >>> proc.completed.returncode
+    0
+
+    By default, both stdout and stderr are streamed. Pass stdout / stderr
+    explicitly to override this (e.g. stderr=STDOUT to merge them).
+
+    With lines=True (default), the output is yielded line by line (long lines
+    are split to chunks of `chunk_size`). With lines=False, the output is
+    yielded in chunks of up to `chunk_size` bytes, as soon as available.
+
+    `input`, `check` and `timeout` are like in run(), with the timeout
+    applying to the entire run (including time spent by the consumer).
+    The exceptions are raised from the iteration, with no captured output.
+
+    The other arguments are the same as for the Popen constructor.
+    """
+    stdin = kwargs.pop('input', None)
+    options = dict(timeout=kwargs.pop('timeout', None),
+                   check=kwargs.pop('check', False),
+                   lines=kwargs.pop('lines', True),
+                   chunk_size=kwargs.pop('chunk_size', _READ_SIZE),
+                   max_pending=kwargs.pop('max_pending', 16))
+    if stdin is not None:
+        if 'stdin' in kwargs:
+            raise ValueError('stdin and input arguments may not both be used.')
+        kwargs['stdin'] = PIPE
+    kwargs.setdefault('stdout', PIPE)
+    kwargs.setdefault('stderr', PIPE)
+    process = Popen(*popenargs, **kwargs)
+    return ProcessStream(popenargs, process, stdin, **options)
+
+
+def _cpu_count():
+    """Return the number of CPUs in the system, or 1 if undetermined."""
+    if hasattr(os, 'cpu_count'):  # Python 3.4 and above
+        return os.cpu_count() or 1
+    import multiprocessing  # imported here, as it's slow to import
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class ProcessPool(object):
+    """A pool that runs commands concurrently with a bounded number of
+       in-flight child processes.
+
+    Every command is executed with `run()`, so `check`, `timeout`, `input`
+    and all other `run()` arguments keep their per-command semantics.
+
+    The bound is shared by all users of the pool, so `ProcessPool.run()` may
+    be called from several threads, in addition to (or in parallel with)
+    `ProcessPool.imap_unordered()`.
+
+    Attributes:
+
+    - max_workers: Maximal number of child processes running concurrently
+                   (defaults to the number of CPUs).
+    """
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = _cpu_count()
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than 0')
+        self.max_workers = max_workers
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def run(self, *popenargs, **kwargs):
+        """Wait for a free slot in the pool, and `run()` the command in it."""
+        with self._slots:
+            return run(*popenargs, **kwargs)
+
+    def imap_unordered(self, commands, **kwargs):
+        """Run every command (args) in `commands` iterable concurrently,
+           yielding `CompletedProcess` instances as the commands finish.
+
+        The keyword arguments are passed to `run()` for every command.
+
+        Results are yielded in completion order, not in submission order -
+        use the `args` attribute to tell them apart.
+
+        If running a command raises (e.g. CalledProcessError with `check`,
+        or TimeoutExpired with `timeout`), the exception is raised from the
+        generator, no new commands are started, and the generator returns
+        once the commands already in flight are done.
+        The same happens if the generator is closed before exhausted.
+        """
+        commands = iter(commands)
+        lock = threading.Lock()
+        results = queue.Queue()
+        stop = threading.Event()
+
+        def worker():
+            """Run commands until exhausted or stopped."""
+            while not stop.is_set():
+                try:
+                    with lock:
+                        args = next(commands)
+                except StopIteration:
+                    break
+                except Exception as exc:  # pylint: disable=broad-except
+                    results.put((None, exc))
+                    break
+                try:
+                    results.put((self.run(args, **kwargs), None))
+                except Exception as exc:  # pylint: disable=broad-except
+                    results.put((None, exc))
+            results.put(None)
+
+        workers = [threading.Thread(target=worker)
+                   for _ in range(self.max_workers)]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        running = len(workers)
+        try:
+            while running:
+                item = results.get()
+                if item is None:
+                    running -= 1
+                    continue
+                cproc, exc = item
+                if exc is not None:
+                    raise exc
+                yield cproc
+        finally:
+            stop.set()
+            for thread in workers:
+                thread.join()
+
+
+def run_many(commands, max_workers=None, **kwargs):
+    """Run every command (args) in `commands` iterable, with up to
+       `max_workers` child processes running concurrently, yielding
+       `CompletedProcess` instances as the commands finish.
+
+    The keyword arguments are passed to `run()` for every command.
+
+    See `ProcessPool.imap_unordered()` for details.
+    """
+    return ProcessPool(max_workers).imap_unordered(commands, **kwargs)
+
+
+# run() arguments that don't affect the result of a command
+_UNCACHED_KWARGS = ('timeout', 'check', 'timeout_policy', 'spawn_backend')
+# run() arguments that can't be part of a key (objects compared by identity)
+_UNKEYABLE_KWARGS = ('preexec_fn', 'startupinfo')
+
+
+def _encode_output(output):
+    """Return captured `output` (bytes, text or None) as a JSON value."""
+    import base64  # imported here, to keep the import of proc fast
+    if output is None or isinstance(output, type('')):
+        return output
+    return {'base64': base64.b64encode(output).decode('ascii')}
+
+
+def _decode_output(value):
+    """Return the captured output encoded by `_encode_output()`."""
+    import base64
+    if isinstance(value, dict):
+        return base64.b64decode(value['base64'])
+    if value is None or isinstance(value, type('')):
+        return value
+    raise ValueError('Invalid output {0!r}'.format(value))
+
+
+def _is_cache_file(name):
+    """Return True if `name` is the name of an on-disk cache entry (a hex
+       sha256 key with a .json extension)."""
+    key, ext = os.path.splitext(name)
+    return (ext == '.json' and len(key) == 64 and
+            not key.strip('0123456789abcdef'))
+
+
+class CommandCache(object):
+    """An opt-in cache of the results of deterministic commands.
+
+    `CommandCache.run()` takes the same arguments as `run()`, and returns
+    the cached `CompletedProcess` of a previous run of the same command, if
+    there is one. A command is the same if its args, env (os.environ if not
+    given), absolute cwd (the current directory if not given), input and the
+    other Popen arguments are, and so are the fingerprints of its
+    `input_files`. Commands with a preexec_fn or startupinfo can't be
+    cached, since those can't be compared.
+
+    A file fingerprint is its mtime and size (fingerprint='stat'), or a hash
+    of its content (fingerprint='hash').
+
+    Results are kept in an in-memory LRU cache of `maxsize` entries, and if
+    `directory` is given, also in files in that directory, so they are
+    shared across processes (and survive restarts). The files are JSON, so
+    loading them never runs code.
+
+    Results are cached whatever the exit code (check=True raises
+    CalledProcessError for cached results too), but not timeouts.
+    Cached results have no metrics (no process was run), and only
+    captured (or discarded) output can be cached - the stdin, stdout and
+    stderr arguments can only be PIPE, DEVNULL, STDOUT or None.
+
+    Attributes:
+
+    - directory: The directory of the on-disk cache (None for memory only).
+    - fingerprint: How input files are fingerprinted ('stat' or 'hash').
+    - memory_hits: Number of results found in memory.
+    - disk_hits: Number of results found on disk.
+    - misses: Number of commands that were actually run.
+    """
+
+    def __init__(self, maxsize=128, directory=None, fingerprint='stat'):
+        if fingerprint not in ('stat', 'hash'):
+            raise ValueError('Unknown fingerprint {0!r}'.format(fingerprint))
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.memory_hits = self.disk_hits = self.misses = 0
+        self._memory = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def _file_fingerprint(self, path):
+        """Return the fingerprint of the file at `path` (None if missing)."""
+        import hashlib  # imported here, to keep the import of proc fast
+        try:
+            if self.fingerprint == 'stat':
+                file_stat = os.stat(path)
+                return (getattr(file_stat, 'st_mtime_ns', file_stat.st_mtime),
+                        file_stat.st_size)
+            digest = hashlib.sha256()
+            with open(path, 'rb') as input_f:
+                for chunk in iter(lambda: input_f.read(_READ_SIZE), b''):
+                    digest.update(chunk)
+            return digest.hexdigest()
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+
+    def key(self, *popenargs, **kwargs):
+        """Return the cache key of running the command with `run()`
+           arguments (and `input_files`) as a hex string."""
+        import hashlib
+        stdin = kwargs.pop('input', None)
+        input_files = kwargs.pop('input_files', ())
+        for name in _UNCACHED_KWARGS:
+            kwargs.pop(name, None)
+        for name in ('stdin', 'stdout', 'stderr'):
+            if kwargs.get(name) not in (None, PIPE, subprocess.STDOUT,
+                                        getattr(subprocess, 'DEVNULL', -3)):
+                raise ValueError(
+                    "Can't cache commands with {0}={1!r}"
+                    .format(name, kwargs[name]))
+        for name in _UNKEYABLE_KWARGS:
+            if kwargs.get(name) is not None:
+                raise ValueError("Can't cache commands with {0}".format(name))
+        env = kwargs.pop('env', None)
+        if env is None:
+            env = os.environ
+        cwd = os.path.abspath(kwargs.pop('cwd', None) or os.curdir)
+        digest = hashlib.sha256(repr((
+            popenargs, sorted(env.items()), cwd, sorted(kwargs.items()),
+            [(path, self._file_fingerprint(path)) for path in input_files],
+        )).encode('utf-8'))
+        if stdin is not None:
+            if not isinstance(stdin, _STRING_TYPES):
+                raise ValueError("Can't cache commands with streamed input")
+            digest.update(stdin.encode('utf-8') if isinstance(stdin, type(''))
+                          else stdin)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        """Return the path of the on-disk cache file of `key`."""
+        return os.path.join(self.directory, key + '.json')
+
+    def _load(self, key):
+        """Return the on-disk cached result of `key` (None if not cached)."""
+        import json  # imported here, to keep the import of proc fast
+        try:
+            with open(self._path(key), 'rb') as cache_f:
+                data = json.loads(cache_f.read().decode('utf-8'))
+            return (int(data['returncode']), _decode_output(data['stdout']),
+                    _decode_output(data['stderr']), data['stdout_size'],
+                    data['stderr_size'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            # missing, or not a valid cache file
+            return None
+
+    def _store(self, key, entry):
+        """Write `entry` to the on-disk cache file of `key`, atomically."""
+        import json
+        import tempfile
+        returncode, stdout, stderr, stdout_size, stderr_size = entry
+        data = json.dumps({'returncode': returncode,
+                           'stdout': _encode_output(stdout),
+                           'stderr': _encode_output(stderr),
+                           'stdout_size': stdout_size,
+                           'stderr_size': stderr_size})
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_f:
+                cache_f.write(data.encode('utf-8'))
+            _replace(temp_path, self._path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def run(self, *popenargs, **kwargs):
+        """Return the cached result of running a command with `run()`,
+           running it (and caching the result) if it isn't cached.
+
+        `input_files` is an optional list of paths of files that the command
+        reads, so their changes invalidate the cached result.
+        """
+        key = self.key(*popenargs, **kwargs)
+        kwargs.pop('input_files', None)
+        check = kwargs.get('check', False)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self.memory_hits += 1
+            elif self.directory is not None:
+                entry = self._load(key)
+                if entry is not None:
+                    self.disk_hits += 1
+                    self._memory.put(key, entry)
+        if entry is None:
+            kwargs['check'] = False
+            result = run(*popenargs, **kwargs)
+            entry = (result.returncode, result.stdout, result.stderr,
+                     result.stdout_size, result.stderr_size)
+            with self._lock:
+                self.misses += 1
+                self._memory.put(key, entry)
+                if self.directory is not None:
+                    self._store(key, entry)
+        else:
+            result = None
+        returncode, stdout, stderr, stdout_size, stderr_size = entry
+        if check and returncode:
+            raise CalledProcessError(returncode, popenargs, output=stdout,
+                                     stderr=stderr, stdout_size=stdout_size,
+                                     stderr_size=stderr_size)
+        if result is None:
+            result = CompletedProcess(popenargs, returncode, stdout, stderr,
+                                      stdout_size=stdout_size,
+                                      stderr_size=stderr_size)
+        return result
+
+    def invalidate(self, *popenargs, **kwargs):
+        """Remove the cached result of the command (given by `run()`
+           arguments) from the cache."""
+        key = self.key(*popenargs, **kwargs)
+        with self._lock:
+            self._memory.pop(key)
+            if self.directory is not None:
+                try:
+                    os.unlink(self._path(key))
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+
+    def clear(self):
+        """Remove all cached results (also on disk - other files in the
+           directory are kept), and reset the counters."""
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+            if self.directory is not None:
+                for name in os.listdir(self.directory):
+                    if _is_cache_file(name):
+                        os.unlink(os.path.join(self.directory, name))
+
+    def stats(self):
+        """Return a dict with the cache hit and miss counters."""
+        with self._lock:
+            return {'memory_hits': self.memory_hits,
+                    'disk_hits': self.disk_hits, 'misses': self.misses}
+
+
+class Pipeline(object):
+    """A shell-like pipeline of commands (`a | b | c`), whose standard output
+       and input are connected directly with OS pipes.
+
+    >>> import sys
+    >>> echo = [sys.executable, '-c', 'print("foo bar")']
+    >>> upper = [sys.executable, '-c',
+    ...          'import sys; sys.stdout.write(sys.stdin.read().upper())']
+    >>> pipeline = Pipeline(echo).pipe(upper, stdout=PIPE)
+    >>> print(pipeline.run()[-1].stdout.decode('ascii').strip())
+    FOO BAR
+
+    Every stage is given `run()`-like arguments (args and Popen arguments),
+    except that the stdin of all stages but the first, and the stdout of all
+    stages but the last, are the pipes between the stages. The data passed
+    between the stages is never copied through Python.
+
+    Attributes:
+
+    - stages: List of (popenargs, kwargs) of the stages.
+    """
+
+    def __init__(self, *commands):
+        self.stages = []
+        for args in commands:
+            self.pipe(args)
+
+    def pipe(self, *popenargs, **kwargs):
+        """Add a stage to the end of the pipeline, and return the pipeline
+           (so calls can be chained)."""
+        self.stages.append((popenargs, kwargs))
+        return self
+
+    def _spawn(self, input_given):
+        """Start the processes of all stages, and return them."""
+        processes = []
+        try:
+            for index, (popenargs, kwargs) in enumerate(self.stages):
+                kwargs = dict(kwargs)
+                if index > 0:
+                    if 'stdin' in kwargs:
+                        raise ValueError(
+                            'stdin may be given only to the first stage')
+                    kwargs['stdin'] = processes[-1].stdout
+                elif input_given:
+                    if 'stdin' in kwargs:
+                        raise ValueError(
+                            'stdin and input arguments may not both be used.')
+                    kwargs['stdin'] = PIPE
+                if index < len(self.stages) - 1:
+                    if 'stdout' in kwargs:
+                        raise ValueError(
+                            'stdout may be given only to the last stage')
+                    kwargs['stdout'] = PIPE
+                process = Popen(*popenargs, **kwargs)
+                if index > 0:
+                    # the child has its own copy now - closing the parent's,
+                    # so the previous stage gets SIGPIPE if this one exits
+                    processes[-1].stdout.close()
+                    processes[-1].stdout = None
+                processes.append(process)
+        except:
+            for process in processes:
+                process.kill()
+                if process.stdout is not None:
+                    process.stdout.close()
+                process.wait()
+            raise
+        return processes
+
+    def run(self, input=None, timeout=None, check=False):
+        # pylint: disable=redefined-builtin
+        """Run all stages concurrently, and return a list of their
+           `CompletedProcess` instances.
+
+        `input` is passed to the stdin of the first stage. Output is
+        captured for stages that are given stdout=PIPE (the last one) or
+        stderr=PIPE.
+
+        If `timeout` expires before all stages terminate, they are all
+        killed, and TimeoutExpired is raised (with the output of the last
+        stage).
+
+        If `check` is True and any stage exited with a non-zero exit status,
+        CalledProcessError is raised for the last such stage, like a shell
+        with the `pipefail` option.
+        """
+        if not self.stages:
+            raise ValueError('Pipeline has no stages')
+        start_time = _clock()
+        processes = self._spawn(input is not None)
+        communicators = [_Communicator(process, start_time)
+                         for process in processes]
+        deadline = None if timeout is None else start_time + timeout
+        for communicator in communicators:
+            communicator._start(  # pylint: disable=protected-access
+                input if communicator is communicators[0] else None)
+        outputs = []
+        try:
+            for communicator in communicators:
+                outputs.append(communicator.communicate(
+                    timeout=None if deadline is None
+                    else max(0, deadline - _clock())))
+        except TimeoutExpired:
+            for communicator in communicators:
+                communicator.process.kill()
+                communicator.kill_time = _clock()
+            for (popenargs, _), communicator in zip(self.stages,
+                                                    communicators):
+                stdout, _ = communicator.communicate()
+                _call_hooks(popenargs, communicator.process.returncode,
+                            communicator.metrics())
+            raise _TimeoutExpired([args for args, _ in self.stages],
+                                  timeout, output=stdout)
+        except:
+            for communicator in communicators:
+                communicator.process.kill()
+                communicator.process.wait()
+            raise
+        results = []
+        for (popenargs, _), communicator, (stdout, stderr) in zip(
+                self.stages, communicators, outputs):
+            metrics = communicator.metrics()
+            returncode = communicator.process.poll()
+            _call_hooks(popenargs, returncode, metrics)
+            results.append(CompletedProcess(popenargs, returncode, stdout,
+                                            stderr, metrics=metrics))
+        if check:
+            for result in reversed(results):
+                if result.returncode:
+                    raise CalledProcessError(result.returncode, result.args,
+                                             output=result.stdout,
+                                             stderr=result.stderr)
+        return results
+
+
+_FRAME_HEADER = struct.Struct('>I')
+
+
+def _write_frame(pipe, data, framing):
+    """Write a `framing` framed message with payload `data` to `pipe`."""
+    if framing == 'line':
+        pipe.write(data + b'\n')
+    else:
+        pipe.write(_FRAME_HEADER.pack(len(data)) + data)
+    pipe.flush()
+
+
+def _read_frame(pipe, framing):
+    """Read a `framing` framed message from `pipe`, and return its payload
+       (None on EOF)."""
+    if framing == 'line':
+        line = pipe.readline()
+        if not line.endswith(b'\n'):
+            return None
+        return line[:-1]
+    header = pipe.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        return None
+    size, = _FRAME_HEADER.unpack(header)
+    data = pipe.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+class Coprocess(object):
+    """A long-lived child process, serving framed requests over its stdin,
+       and framed responses over its stdout.
+
+    Keeping the child alive between requests amortizes the process startup
+    cost over many requests, for interpreters and tools that can process a
+    stream of inputs.
+
+    The child is started on the first request, and is restarted on the next
+    request after it crashes or fails to respond in time.
+
+    Supported framings (the child must speak the same protocol):
+
+    - 'length' (default): A 4 bytes big-endian payload length, followed by
+      the payload.
+    - 'line': The payload followed by a newline (so the payload must not
+      contain newlines).
+
+    The other arguments are the same as for the Popen constructor,
+    excluding stdin and stdout (used internally). The child's stderr must
+    not be a PIPE (nobody would read it), and is inherited by default.
+
+    Attributes:
+
+    - args: The list or str args of the child process.
+    - health_request: Payload of a request used by check_health() to tell
+                      that the child is responsive (None to only check that
+                      it is running).
+    - max_restarts: Maximal number of restarts (None for unlimited),
+                    after which requests raise SubprocessError.
+    - restarts: Number of times the child was restarted so far.
+    """
+
+    def __init__(self, args, framing='length', health_request=None,
+                 max_restarts=None, **kwargs):
+        if framing not in ('length', 'line'):
+            raise ValueError('Unknown framing {0!r}'.format(framing))
+        if 'stdin' in kwargs or 'stdout' in kwargs:
+            raise ValueError('stdin and stdout are used by Coprocess.')
+        if kwargs.get('stderr') == PIPE:
+            raise ValueError('Coprocess stderr may not be a PIPE.')
+        self.args = args
+        self.framing = framing
+        self.health_request = health_request
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self._kwargs = kwargs
+        self._started = False
+        self._process = None
+        self._responses = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """Start the child process, and a thread reading its responses."""
+        process = Popen(self.args, stdin=PIPE, stdout=PIPE, **self._kwargs)
+        responses = queue.Queue()
+
+        def reader():
+            """Queue responses until EOF (marked with None)."""
+            try:
+                while True:
+                    data = _read_frame(process.stdout, self.framing)
+                    responses.put(data)
+                    if data is None:
+                        break
+            except (IOError, OSError, ValueError):
+                responses.put(None)
+
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        self._started = True
+        self._process = process
+        self._responses = responses
+
+    def _ensure_running(self):
+        """Start the child process if not running (lock held)."""
+        if self._process is None or self._process.poll() is not None:
+            if self._started:
+                self._restart()
+            else:
+                self._start()
+
+    def _stop(self):
+        """Kill the child process (if running)."""
+        process, self._process = self._process, None
+        if process is not None:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            for pipe in (process.stdin, process.stdout):
+                try:
+                    pipe.close()
+                except (IOError, OSError):
+                    pass
+
+    def is_alive(self):
+        """Return True if the child process is running."""
+        return self._process is not None and self._process.poll() is None
+
+    def restart(self):
+        """Kill the child process (if running), and start a new one."""
+        with self._lock:
+            self._restart()
+
+    def _restart(self):
+        """Restart the child process (lock held)."""
+        if self.max_restarts is not None and \
+                self.restarts >= self.max_restarts:
+            raise SubprocessError('Coprocess {0!r} restarted too many times'
+                                  .format(self.args))
+        self._stop()
+        self.restarts += 1
+        self._start()
+
+    def request(self, data, timeout=None):
+        """Send a request with payload `data` (bytes) to the child, and return
+           a `CompletedProcess` with the response payload as stdout.
+
+        If the child doesn't respond within `timeout` seconds, it is killed
+        and TimeoutExpired is raised.
+        If the child terminates before responding, CalledProcessError is
+        raised with its exit code.
+        In both cases the child is restarted on the next request.
+        """
+        with self._lock:
+            self._ensure_running()
+            process = self._process
+            try:
+                _write_frame(process.stdin, data, self.framing)
+            except (IOError, OSError):
+                # the child died - wait for the reader to hit EOF
+                pass
+            try:
+                response = self._responses.get(timeout=timeout)
+            except queue.Empty:
+                self._stop()
+                raise _TimeoutExpired(self.args, timeout)
+            if response is None:
+                retcode = process.wait()
+                self._stop()
+                raise CalledProcessError(retcode, self.args)
+            return CompletedProcess(self.args, 0, response)
+
+    def check_health(self, timeout=None):
+        """Return True if the child is running (and responds to the health
+           request within `timeout`, if set).
+
+        If not, the child is restarted, and False is returned.
+        A child that was never started is started by the first check.
+        """
+        with self._lock:
+            if not self._started:
+                self._start()
+        healthy = self.is_alive()
+        if healthy and self.health_request is not None:
+            try:
+                self.request(self.health_request, timeout)
+            except SubprocessError:
+                healthy = False
+        if not healthy:
+            self.restart()
+        return healthy
+
+    def close(self, timeout=None):
+        """Close the child's stdin, and wait up to `timeout` seconds for it
+           to exit before killing it."""
+        with self._lock:
+            process = self._process
+            if process is None:
+                return
+            try:
+                process.stdin.close()
+                if __timeout__:
+                    process.wait(timeout=timeout)
+                else:
+                    process.wait()
+            except (IOError, OSError, TimeoutExpired):
+                pass
+            self._stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CoprocessPool(object):
+    """A pool of `Coprocess` instances of the same command, serving requests
+       from multiple threads concurrently.
+
+    The arguments (except `size`) are the same as for `Coprocess`.
+
+    Attributes:
+
+    - workers: The list of Coprocess instances in the pool (defaults to the
+               number of CPUs).
+    """
+
+    def __init__(self, args, size=None, **kwargs):
+        if size is None:
+            size = _cpu_count()
+        if size < 1:
+            raise ValueError('size must be greater than 0')
+        self.workers = [Coprocess(args, **kwargs) for _ in range(size)]
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def request(self, data, timeout=None):
+        """Wait for an idle worker, and send it the request.
+
+        See `Coprocess.request()`.
+        """
+        worker = self._idle.get()
+        try:
+            return worker.request(data, timeout)
+        finally:
+            self._idle.put(worker)
+
+    def check_health(self, timeout=None):
+        """Check the health of all workers (restarting unhealthy ones),
+           and return True if all were healthy.
+
+        See `Coprocess.check_health()`.
+        """
+        healthy = True
+        for worker in self.workers:
+            healthy = worker.check_health(timeout) and healthy
+        return healthy
+
+    def close(self, timeout=None):
+        """Close all workers - see `Coprocess.close()`."""
+        for worker in self.workers:
+            worker.close(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if sys.version_info >= (3, 7):
+
+    def __getattr__(name):
+        """Import run_async (and asyncio) on first use (PEP 562)."""
+        if name != 'run_async':
+            raise AttributeError('module {0!r} has no attribute {1!r}'
+                                 .format(__name__, name))
+        from ostrich.utils._aioproc import run_async as value
+        globals()[name] = value  # later lookups skip __getattr__
+        return value
+
+elif sys.version_info >= (3, 5):
+    # pylint: disable=wrong-import-position
+    from ostrich.utils import _aioproc
+    run_async = _aioproc.run_async
@@ -13,15 +13,29 @@ A collection of text-related utility functions. Hurray!
 from __future__ import absolute_import
 from __future__ import unicode_literals  # so strings without u'' are unicode
 
-# uniform unicode type across Python's
-from builtins import str as text  # from "future" library
-
+import codecs
+import errno
+import os
 import re
+import sys
+import threading
 import unicodedata
 
+if sys.version_info[0] < 3:
+    # uniform unicode type across Python's
+    from builtins import str as text  # from "future" library
+else:
+    text = str  # pylint: disable=invalid-name
+
+from ostrich.utils.collections import LRUCache
 
-_SAFE_PATH_RE = re.compile(r'[^a-zA-Z0-9\-\_\=\.]')
+
+_SAFE_PATH_PATTERN = r'[^a-zA-Z0-9\-\_\=\.]'
+_SAFE_PATH_RE = None  # compiled on first use, see _safe_path_re()
 _MAX_PATH_NAME_LEN = 255
+_SAFE_PATHS_CACHE_SIZE = 4096
+_scandir = getattr(os, 'scandir', None)  # Python 3.5+
+_READ_SIZE = 64 * 1024
 
 
 def as_text(str_or_bytes, encoding='utf-8', errors='strict'):
@@ -34,13 +48,115 @@ def as_text(str_or_bytes, encoding='utf-8', errors='strict'):
     foo
     >>> b'foo'.decode('utf-8') == u'foo'
     True
+
+    Other bytes-like objects (bytearray, memoryview, mmap...) are decoded
+    in place, without copying them to bytes first.
+
+    >>> print(as_text(memoryview(b'foo bar')[4:]))
+    bar
     """
     if isinstance(str_or_bytes, text):
         return str_or_bytes
-    return str_or_bytes.decode(encoding, errors)
+    try:
+        decode = str_or_bytes.decode
+    except AttributeError:
+        # a buffer - the codec functions accept any bytes-like object
+        return codecs.lookup(encoding).decode(str_or_bytes, errors)[0]
+    return decode(encoding, errors)
+
+
+def _read_chunks(source, chunk_size):
+    """Yield the chunks of `source` - a file object or an iterable."""
+    if not hasattr(source, 'read'):
+        for chunk in source:
+            yield chunk
+        return
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _decode_chunks(source, encoding, errors, chunk_size):
+    """Yield the non-empty text chunks decoded from `source`."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    for chunk in _read_chunks(source, chunk_size):
+        if not isinstance(chunk, text):
+            chunk = decoder.decode(chunk)
+        if chunk:
+            yield chunk
+    chunk = decoder.decode(b'', final=True)
+    if chunk:
+        yield chunk
+
+
+def iter_text(source, encoding='utf-8', errors='strict', lines=False,
+              chunk_size=_READ_SIZE):
+    """Decode `source` incrementally, yielding text strings.
+
+    `source` is either an iterable of bytes-like objects (e.g. bytes, or
+    memoryview slices of a large buffer), or a binary file object
+    (read `chunk_size` bytes at a time). Like `as_text`, chunks that are
+    already text strings are passed through, and `encoding` and `errors` are
+    used to decode the rest. Multi-byte sequences that are split across
+    chunks are decoded correctly. Note that the incremental decoder copies
+    every chunk to bytes, so (unlike `as_text`) memoryview chunks are not
+    decoded in place.
+
+    >>> list(iter_text([b'caf', b'\\xc3', b'\\xa9'])) == ['caf', '\\xe9']
+    True
 
+    If `lines` is True, lines are yielded (including their trailing '\\n')
+    regardless of how the chunks are split.
 
-def get_safe_path(in_str):
+    >>> list(iter_text([b'foo\\nb', b'ar\\n\\nbaz'], lines=True)) == [
+    ...     'foo\\n', 'bar\\n', '\\n', 'baz']
+    True
+
+    Only a single chunk (or line) is held in memory at a time.
+    """
+    chunks = _decode_chunks(source, encoding, errors, chunk_size)
+    if not lines:
+        for chunk in chunks:
+            yield chunk
+        return
+    pending = []
+    for chunk in chunks:
+        start = 0
+        end = chunk.find('\n')
+        while end >= 0:
+            pending.append(chunk[start:end + 1])
+            yield ''.join(pending)
+            pending = []
+            start = end + 1
+            end = chunk.find('\n', start)
+        if start < len(chunk):
+            pending.append(chunk[start:])
+    if pending:
+        yield ''.join(pending)
+
+
+try:
+    _is_ascii = text.isascii  # Python 3.7+
+except AttributeError:
+    def _is_ascii(in_text):
+        """Return True if the text string `in_text` is pure ASCII."""
+        try:
+            in_text.encode('ascii')
+        except UnicodeError:
+            return False
+        return True
+
+
+def _safe_path_re():
+    """Return the compiled regex of `get_safe_path`."""
+    global _SAFE_PATH_RE  # pylint: disable=global-statement
+    _SAFE_PATH_RE = re.compile(_SAFE_PATH_PATTERN)
+    return _SAFE_PATH_RE
+
+
+def get_safe_path(in_str, cache=None):
     """Return `in_str` converted to a string that can be be safely used as a
        path (either filename, or directory name).
 
@@ -61,10 +177,175 @@ def get_safe_path(in_str):
 
     >>> get_safe_path(' foo/bar.baz') == get_safe_path('foo$bar.baz ')
     True
+
+    If `cache` is given (an `ostrich.utils.collections.LRUCache`), results
+    are memoized in it, which pays off when inputs repeat a lot.
+
+    >>> from ostrich.utils.collections import LRUCache
+    >>> cache = LRUCache(maxsize=1000)
+    >>> print(get_safe_path('foo bar', cache=cache))
+    foo_bar
+    >>> print(get_safe_path('foo bar', cache=cache))
+    foo_bar
+    >>> cache.hits, cache.misses
+    (1, 1)
     """
-    norm_str = _SAFE_PATH_RE.sub(
-        '_', unicodedata.normalize('NFKD', as_text(in_str)).strip())
+    if cache is not None:
+        if isinstance(in_str, (bytearray, memoryview)):
+            in_str = bytes(in_str)  # hashable, for the cache key
+        safe_path = cache.get(in_str)
+        if safe_path is None:
+            safe_path = get_safe_path(in_str)
+            cache.put(in_str, safe_path)
+        return safe_path
+    in_text = as_text(in_str)
+    if not _is_ascii(in_text):
+        # ASCII strings are NFKD-normalized already
+        in_text = unicodedata.normalize('NFKD', in_text)
+    norm_str = (_SAFE_PATH_RE or _safe_path_re()).sub('_', in_text.strip())
     if len(norm_str.strip('.')) == 0:
         # making sure the normalized result is non-empty, and not just dots
         raise ValueError(in_str)
     return norm_str[:_MAX_PATH_NAME_LEN]
+
+
+def get_safe_paths(in_strs, cache=None):
+    """Return a list of the `in_strs` iterable converted by `get_safe_path`.
+
+    >>> get_safe_paths(['a b', 'c?', 'a b']) == ['a_b', 'c_', 'a_b']
+    True
+
+    Repeating inputs are converted once - using `cache` if given (an
+    `ostrich.utils.collections.LRUCache`, that may be shared across batches),
+    or a new bounded cache for the batch.
+
+    Raises ValueError for the first input that `get_safe_path` rejects.
+    """
+    if cache is None:
+        cache = LRUCache(maxsize=_SAFE_PATHS_CACHE_SIZE)
+    return [get_safe_path(in_str, cache) for in_str in in_strs]
+
+
+class SafePathAllocator(object):
+    """Allocate unique safe path names (see `get_safe_path`) per directory,
+       without checking the filesystem for every name.
+
+    Names that were already issued in a directory are kept in an in-memory
+    index, and colliding names get a deterministic "_<N>" suffix (before the
+    extension), keeping them within the maximal path name length.
+
+    >>> allocator = SafePathAllocator()
+    >>> print(allocator.allocate('foo?.txt'))
+    foo_.txt
+    >>> print(allocator.allocate('foo!.txt'))
+    foo__1.txt
+    >>> print(allocator.allocate('foo!.txt', directory='bar'))
+    foo_.txt
+
+    If `scan` is True, the index of a directory is seeded with its existing
+    entries (using a single directory listing) the first time it is used.
+    If `case_sensitive` is False, names that differ only by case collide
+    (as they do on case-insensitive filesystems).
+
+    :warning: The allocator only knows about names it issued (or found when
+              scanning) - it can't prevent races with other processes that
+              create files in the same directories.
+
+    Attributes:
+
+    - scan: Whether directories are scanned when first used.
+    - case_sensitive: Whether names that differ by case are distinct.
+    - cache: An `ostrich.utils.collections.LRUCache` for `get_safe_path`
+             results (None to disable).
+    """
+
+    def __init__(self, scan=False, case_sensitive=True, cache=None):
+        self.scan = scan
+        self.case_sensitive = case_sensitive
+        self.cache = cache
+        # directory -> (set of issued name keys, {name key: next suffix})
+        self._directories = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name):
+        """Return the index key of `name`."""
+        return name if self.case_sensitive else name.lower()
+
+    def _index(self, directory):
+        """Return the index of `directory`, creating (and seeding) it if
+           needed."""
+        directory = os.path.normpath(directory) if directory else ''
+        index = self._directories.get(directory)
+        if index is None:
+            names = _list_dir(directory or os.curdir) if self.scan else ()
+            index = set(self._key(name) for name in names), {}
+            self._directories[directory] = index
+        return index
+
+    def _unique(self, name, index):
+        """Return `name`, or the first suffixed variant of it that isn't in
+           `index`, and add it to the index."""
+        issued, suffixes = index
+        key = self._key(name)
+        if key in issued:
+            stem, ext = os.path.splitext(name)
+            suffix_num = suffixes.get(key, 1)
+            while True:
+                suffix = '_{0}'.format(suffix_num)
+                suffix_num += 1
+                if len(suffix) + len(ext) >= _MAX_PATH_NAME_LEN:
+                    # an absurdly long extension - suffix the whole name
+                    stem, ext = name, ''
+                candidate = (stem[:_MAX_PATH_NAME_LEN - len(suffix) - len(ext)]
+                             + suffix + ext)
+                if self._key(candidate) not in issued:
+                    break
+            suffixes[key] = suffix_num
+            name, key = candidate, self._key(candidate)
+        issued.add(key)
+        return name
+
+    def allocate(self, in_str, directory=''):
+        """Return a safe path name for `in_str` that wasn't issued yet in
+           `directory`.
+
+        Raises ValueError if `get_safe_path` rejects `in_str`.
+        """
+        name = get_safe_path(in_str, self.cache)
+        with self._lock:
+            return self._unique(name, self._index(directory))
+
+    def allocate_many(self, in_strs, directory=''):
+        """Return a list of unique safe path names for the `in_strs`
+           iterable, in `directory`.
+
+        >>> names = SafePathAllocator().allocate_many(['a b', 'a?b', 'a_b'])
+        >>> names == ['a_b', 'a_b_1', 'a_b_2']
+        True
+        """
+        names = get_safe_paths(in_strs, self.cache)
+        with self._lock:
+            index = self._index(directory)
+            return [self._unique(name, index) for name in names]
+
+    def reserve(self, name, directory=''):
+        """Mark `name` as taken in `directory`, so it won't be allocated."""
+        with self._lock:
+            self._index(directory)[0].add(self._key(name))
+
+    def release(self, name, directory=''):
+        """Make a previously issued `name` in `directory` available again."""
+        with self._lock:
+            self._index(directory)[0].discard(self._key(name))
+
+
+def _list_dir(directory):
+    """Return the entry names of `directory` (empty if it doesn't exist)."""
+    try:
+        if _scandir is None:
+            return os.listdir(directory)
+        return [entry.name for entry in _scandir(directory)]
+    except OSError as exc:
+        if exc.errno in (errno.ENOENT, errno.ENOTDIR):
+            return []
+        raise
@@ -20,7 +20,7 @@ setup(
     description=ostrich.__oneliner__,
     long_description=long_description,
     packages=find_packages(),
-    install_requires=['future'],
+    install_requires=['future; python_version < "3"'],
     setup_requires=['pytest-runner'],
     extras_require={
         'test': ['pytest', 'pytest-cov', 'pytest-pep8'],
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+
+"""Tests for fs utils module"""
+
+
+from __future__ import unicode_literals
+
+import errno
+import os
+
+from ostrich.utils.fs import _rename, sanitize_tree
+
+
+def make_tree(tmpdir):
+    """Create a tree with unsafe names in several levels, and return its
+       root path."""
+    root = tmpdir.mkdir('root')
+    top = root.mkdir('top dir')
+    top.join('a b.txt').write('1')
+    top.join('a_b.txt').write('2')
+    top.mkdir('sub?dir').join('café!.txt').write('3')
+    root.join('...').write('4')
+    root.join('fine.txt').write('5')
+    return str(root)
+
+
+def list_tree(root):
+    """Return a sorted list of the relative paths under `root`."""
+    return sorted(os.path.relpath(os.path.join(dirpath, name), root)
+                  for dirpath, dirnames, filenames in os.walk(root)
+                  for name in dirnames + filenames)
+
+
+def test_sanitize_tree(tmpdir):
+    root = make_tree(tmpdir)
+    result = sanitize_tree(root, max_workers=4, batch_size=2)
+    assert not result.dry_run
+    assert 7 == result.scanned
+    assert 4 == result.renamed
+    assert sorted([
+        '...', 'fine.txt', 'top_dir', os.path.join('top_dir', 'a_b.txt'),
+        os.path.join('top_dir', 'a_b_1.txt'),
+        os.path.join('top_dir', 'sub_dir'),
+        os.path.join('top_dir', 'sub_dir', 'cafe__.txt'),
+    ]) == list_tree(root)
+    with open(os.path.join(root, 'top_dir', 'a_b_1.txt')) as renamed_f:
+        assert '1' == renamed_f.read()
+    # the name that can't be made safe is reported, and left as is
+    assert [os.path.join(root, '...')] == [path for path, _ in result.errors]
+    assert result.rate > 0
+
+
+def test_sanitize_tree_dry_run(tmpdir):
+    """Check that the plan is bottom-up, and nothing is renamed"""
+    root = make_tree(tmpdir)
+    before = list_tree(root)
+    result = sanitize_tree(root, dry_run=True)
+    assert before == list_tree(root)
+    assert 0 == result.renamed
+    top = os.path.join(root, 'top dir')
+    assert [
+        (os.path.join(top, 'sub?dir', 'café!.txt'),
+         os.path.join(top, 'sub?dir', 'cafe__.txt')),
+        (os.path.join(top, 'a b.txt'), os.path.join(top, 'a_b_1.txt')),
+        (os.path.join(top, 'sub?dir'), os.path.join(top, 'sub_dir')),
+        (top, os.path.join(root, 'top_dir')),
+    ] == result.plan
+    assert '{0} -> {1}\n'.format(*result.plan[0]) in result.format_plan()
+
+
+def test_rename_no_overwrite(tmpdir):
+    """Check that renames never overwrite an existing entry"""
+    old_path, new_path = str(tmpdir.join('a b')), str(tmpdir.join('A_B'))
+    for path in (old_path, new_path):
+        with open(path, 'w') as out_f:
+            out_f.write(path)
+    error = _rename((old_path, new_path))
+    assert errno.EEXIST == error.errno
+    with open(new_path) as in_f:
+        assert new_path == in_f.read()
+    assert os.path.exists(old_path)
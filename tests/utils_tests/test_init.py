@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+
+"""Tests for the utils package"""
+
+
+from __future__ import unicode_literals
+
+from os.path import abspath, dirname
+import subprocess
+import sys
+
+import pytest
+
+import ostrich.utils
+
+
+def test_public_attrs():
+    from ostrich.utils.proc import run
+    assert run is ostrich.utils.run
+    assert [1] == ostrich.utils.listify(1)
+    assert 'foo' == ostrich.utils.commonpath(['foo/bar', 'foo/baz'])
+    assert 'foo_bar' == ostrich.utils.get_safe_path(ostrich.utils.as_text(
+        b'foo bar'))
+    with pytest.raises(AttributeError):
+        ostrich.utils.no_such_util  # pylint: disable=pointless-statement
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='lazy loading requires Python 3.7+')
+def test_lazy_loading():
+    """Check that only the modules of used attributes are imported"""
+    code = ('import sys; import ostrich.utils as utils; utils.listify(1); '
+            'print(sorted(m for m in sys.modules if m.startswith("ostrich")))')
+    root_dir = dirname(dirname(dirname(abspath(__file__))))
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=root_dir)
+    assert (b"['ostrich', 'ostrich.utils', 'ostrich.utils.collections']" ==
+            output.strip())
@@ -5,9 +5,13 @@
 """Tests for path utils module"""
 
 
+import random
+
 import pytest
 
-from ostrich.utils.path import commonpath, nt_commonpath, posix_commonpath
+from ostrich.utils.path import (
+    commonpath, commonpath_many, CommonPathAccumulator, nt_commonpath,
+    PathTrie, posix_commonpath)
 
 
 def test_posix_commonpath_abs():
@@ -24,6 +28,10 @@ def test_posix_commonpath_abs():
     assert '/usr' == posix_commonpath(['/usr/lib/', '/usr/lib64/'])
     assert '/usr' == posix_commonpath(['/usr/lib', '/usr/lib64'])
     assert '/usr' == posix_commonpath(['/usr/lib/', '/usr/lib64'])
+    # Paths sorted between paths with a common component
+    assert '/usr' == posix_commonpath(['/usr/lib', '/usr/lib-x', '/usr/lib/x'])
+    assert '/usr/lib' == posix_commonpath(['/usr/lib', '/usr/lib/-x',
+                                           '/usr/lib/x'])
 
 
 def test_posix_commonpath_rel():
@@ -40,6 +48,29 @@ def test_posix_commonpath_rel():
     assert '' == posix_commonpath(['', 'spam/alot'])
     # Actually check the difference from commonprefix
     assert 'i' == posix_commonpath(['i/spam/a/lot', 'i/spa/m/alot'])
+    assert 'a.' == posix_commonpath(['a./b', 'a./c'])
+    assert b'a' == posix_commonpath([b'a/b', b'a/b.c', b'a/b c'])
+
+
+def test_posix_commonpath_random():
+    """Compare POSIX-specific commonpath with Python 3.5 posixpath"""
+    posixpath = pytest.importorskip('posixpath')
+    if not hasattr(posixpath, 'commonpath'):
+        return
+    rand = random.Random(47)
+    components = ['a', 'b', 'a-b', 'a.b', 'a b', '.', '', '..', 'a/']
+    for _ in range(5000):
+        prefix = rand.choice(['/', ''])
+        paths = [prefix + '/'.join(rand.choice(components)
+                                   for _ in range(rand.randint(0, 4)))
+                 for _ in range(rand.randint(1, 5))]
+        try:
+            expected = posixpath.commonpath(paths)
+        except ValueError:
+            with pytest.raises(ValueError):
+                posix_commonpath(paths)
+        else:
+            assert expected == posix_commonpath(paths)
 
 
 def test_posix_commonpath_err():
@@ -130,3 +161,165 @@ def test_generic_commonpath():
 def test_generic_commonpath_err():
     with pytest.raises(TypeError):
         commonpath([None])
+
+
+def test_commonpath_many():
+    assert ['foo', 'spam'] == commonpath_many([['foo/bar', 'foo/baz'],
+                                               ['spam']])
+    assert [] == commonpath_many([])
+    with pytest.raises(ValueError):
+        commonpath_many([['foo'], []])
+
+
+def test_path_trie_posix():
+    """Test PathTrie queries with POSIX paths"""
+    paths = ['/usr/lib/python3', '/usr/lib//python2', '/usr/./lib64',
+             '/usr/bin/python', '/usr/lib/python3']
+    trie = PathTrie(paths, flavor='posix')
+    assert 5 == len(trie)
+    assert posix_commonpath(paths) == trie.commonpath()
+    assert '/usr/lib' == trie.commonpath(['/usr/lib/python3',
+                                          '/usr/lib/python2'])
+    assert 5 == trie.count('/usr')
+    assert 3 == trie.count('/usr/lib/')
+    assert 2 == trie.count('/usr/lib/python3')
+    assert 0 == trie.count('/usr/local')
+    assert 0 == trie.count('usr')
+    assert ({'/usr/lib': 3, '/usr/lib64': 1, '/usr/bin': 1} ==
+            trie.group(2))
+    assert {'/usr/lib/python3': 2, '/usr/lib/python2': 1} == trie.group(
+        1, prefix='/usr/lib')
+    assert {'/usr': 5} == trie.group(1)
+
+    trie.add('/usr')
+    assert '/usr' == trie.commonpath()
+    assert 1 == trie.group(2)['/usr']
+    trie.add('/')
+    assert '/' == trie.commonpath()
+
+    assert b'spam' == PathTrie([b'spam/a', b'spam/b'],
+                               flavor='posix').commonpath()
+
+
+def test_path_trie_nt():
+    """Test PathTrie queries with NT paths"""
+    paths = ['C:\\Program Files\\Foo', 'c:/program files/bar',
+             'C:\\Program Files\\Foo\\Baz']
+    trie = PathTrie(paths, flavor='nt')
+    assert nt_commonpath(paths) == trie.commonpath()
+    assert 'C:\\Program Files' == trie.commonpath()
+    assert 2 == trie.count('c:\\PROGRAM FILES\\foo')
+    assert ({'C:\\Program Files\\Foo': 2, 'C:\\Program Files\\bar': 1} ==
+            trie.group(2))
+
+
+def test_path_trie_err():
+    """Test PathTrie in error conditions, consistent with commonpath"""
+    with pytest.raises(ValueError):
+        PathTrie(flavor='posix').commonpath()
+    with pytest.raises(ValueError):
+        PathTrie(['/usr', 'usr'], flavor='posix')
+    with pytest.raises(TypeError):
+        PathTrie(['/usr', b'/usr'], flavor='posix')
+    with pytest.raises(TypeError):
+        PathTrie([None])
+    with pytest.raises(ValueError):
+        PathTrie(['C:\\Program Files', 'D:\\Program Files'], flavor='nt')
+    with pytest.raises(ValueError):
+        PathTrie(['/usr'], flavor='posix').commonpath(['usr'])
+    # all paths are checked for mixing absolute and relative paths first
+    trie = PathTrie(['C:\\usr'], flavor='nt')
+    with pytest.raises(ValueError) as excinfo:
+        trie.commonpath(['D:\\usr', 'usr'])
+    assert 'absolute and relative' in str(excinfo.value)
+    with pytest.raises(ValueError) as excinfo:
+        nt_commonpath(['C:\\usr', 'D:\\usr', 'usr'])
+    assert 'absolute and relative' in str(excinfo.value)
+    with pytest.raises(ValueError):
+        PathTrie(['/usr'], flavor='mac')
+    # queries don't fix the type of an empty trie
+    trie = PathTrie(flavor='posix')
+    assert 0 == trie.count('foo')
+    trie.add(b'foo')
+    assert b'foo' == trie.commonpath()
+
+
+def _accumulated(paths, flavor, parts=1):
+    """Return the result of CommonPathAccumulator(s) over `paths`,
+       merging `parts` partial accumulators, or the raised error type."""
+    # contiguous slices, as merging keeps the spelling of the first path
+    accs = [CommonPathAccumulator(flavor=flavor) for _ in range(parts)]
+    for i, path in enumerate(paths):
+        accs[i * parts // max(len(paths), 1)].add(path)
+    for acc in accs[1:]:
+        accs[0].merge(acc)
+    try:
+        return accs[0].result()
+    except (TypeError, ValueError) as exc:
+        return type(exc)
+
+
+def _expected(func, paths):
+    """Return the result of commonpath `func`, or the raised error type."""
+    try:
+        return func(paths)
+    except (TypeError, ValueError) as exc:
+        return type(exc)
+
+
+def test_commonpath_accumulator():
+    """Compare CommonPathAccumulator with commonpath, also when merged"""
+    cases = [
+        ['/usr/local', '/usr/local/bin', '/usr//local/lib/'],
+        ['/usr', '/dev'],
+        ['spam', 'spam/alot', './spam/eggs'],
+        ['', 'spam/alot'],
+        [b'/usr/lib/', b'/usr/lib/python3'],
+        ['/usr', 'usr'],
+        [b'/usr', '/usr'],
+        ['/usr', None, b'/usr'],
+        [],
+    ]
+    for paths in cases:
+        for parts in (1, 2, 3):
+            assert (_expected(posix_commonpath, paths) ==
+                    _accumulated(paths, 'posix', parts))
+    nt_cases = [
+        ['C:\\Program Files\\Foo', 'c:/program files/bar'],
+        ['c:/program files/bar', 'C:\\Program Files\\Foo'],
+        ['C:\\Program Files', 'D:\\Program Files'],
+        ['C:and\\spam', 'C:and\\jam', 'C:and'],
+        ['', '\\spam\\alot'],
+    ]
+    for paths in nt_cases:
+        for parts in (1, 2):
+            assert (_expected(nt_commonpath, paths) ==
+                    _accumulated(paths, 'nt', parts))
+    with pytest.raises(ValueError):
+        CommonPathAccumulator(flavor='nt').merge(
+            CommonPathAccumulator(flavor='posix'))
+
+
+def test_commonpath_accumulator_merged_copy():
+    """Check that adding to a merged accumulator doesn't affect the merge"""
+    for flavor in ('posix', 'nt'):
+        acc = CommonPathAccumulator(flavor=flavor)
+        other = CommonPathAccumulator(['/usr/lib/x'], flavor=flavor)
+        acc.merge(other)
+        other.add('/etc')
+        sep = '/' if flavor == 'posix' else '\\'
+        assert sep.join(['', 'usr', 'lib', 'x']) == acc.result()
+        assert sep == other.result()
+
+
+def test_commonpath_buffers():
+    """Check that bytearray and memoryview paths are treated as bytes"""
+    paths = [bytearray(b'/usr/lib/foo'), memoryview(b'/usr/lib/bar'),
+             b'/usr/local']
+    assert b'/usr' == posix_commonpath(paths)
+    assert b'c:\\usr' == nt_commonpath([bytearray(b'c:\\usr\\lib'),
+                                        memoryview(b'c:/usr/bin')])
+    assert b'/usr' == CommonPathAccumulator(paths, flavor='posix').result()
+    assert b'/usr/lib' == PathTrie(paths[:2], flavor='posix').commonpath()
+    with pytest.raises(TypeError):
+        posix_commonpath(['/usr', bytearray(b'/usr')])
@@ -5,13 +5,19 @@
 """Tests for path utils module"""
 
 
+import io
+import json
 import os
 import sys
+import time
 
 import pytest
 
 import ostrich
-from ostrich.utils.proc import CalledProcessError, PIPE, run, TimeoutExpired
+from ostrich.utils.proc import (
+    add_hook, CalledProcessError, CommandCache, Coprocess, CoprocessPool, PIPE,
+    Pipeline, ProcessPool, remove_hook, ResourceLimitExceeded, ResourceLimits,
+    run, run_many, stream, TimeoutExpired, TimeoutPolicy)
 
 
 def test_run():
@@ -74,3 +80,562 @@ def test_run_timeout():
              'import sys, time; sys.stdout.write("BDFL");'
              'sys.stdout.flush(); time.sleep(3600)'], timeout=0.1, stdout=PIPE)
     assert 'BDFL' in str(excinfo.value)
+
+
+def test_run_many():
+    """Test that run_many runs commands concurrently"""
+    commands = [[sys.executable, '-c',
+                 'import time; time.sleep(0.5); print({0})'.format(i)]
+                for i in range(4)]
+    start = time.time()
+    cprocs = list(run_many(commands, max_workers=4, stdout=PIPE))
+    assert time.time() - start < 2.0
+    assert [b'0\n', b'1\n', b'2\n', b'3\n'] == sorted(
+        cproc.stdout for cproc in cprocs)
+
+    cprocs = list(run_many([[sys.executable, '-c', 'import sys; sys.exit(3)']],
+                           max_workers=1))
+    assert [3] == [cproc.returncode for cproc in cprocs]
+
+
+def test_run_many_check():
+    """Test that run_many raises for failing commands with check=True"""
+    commands = [[sys.executable, '-c', 'import sys; sys.exit(0)'],
+                [sys.executable, '-c', 'import sys; sys.exit(5)']]
+    with pytest.raises(CalledProcessError) as excinfo:
+        list(run_many(commands, max_workers=1, check=True))
+    assert 5 == excinfo.value.returncode
+
+    with pytest.raises(ValueError):
+        ProcessPool(0)
+
+
+def test_run_async():
+    """Test the asyncio-native proc.run_async coroutine"""
+    if not hasattr(ostrich.utils.proc, 'run_async'):
+        return
+    import asyncio
+    from ostrich.utils.proc import run_async
+
+    def run_sync(*popenargs, **kwargs):
+        """Run run_async in a new event loop."""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run_async(*popenargs, **kwargs))
+        finally:
+            loop.close()
+
+    upper = 'import sys; sys.stdout.write(sys.stdin.read().upper())'
+    cproc = run_sync([sys.executable, '-c', upper],
+                     input=b'spam', stdout=PIPE)
+    assert b'SPAM' == cproc.stdout
+    assert 0 == cproc.returncode
+
+    cproc = run_sync([sys.executable, '-c', 'print("BDFL")'], stdout=PIPE,
+                     universal_newlines=True)
+    assert 'BDFL\n' == cproc.stdout
+
+    with pytest.raises(CalledProcessError) as excinfo:
+        run_sync([sys.executable, '-c', 'import sys; sys.exit(47)'],
+                 check=True)
+    assert 47 == excinfo.value.returncode
+
+    with pytest.raises(TimeoutExpired) as excinfo:
+        run_sync([sys.executable, '-c',
+                  'import sys, time; sys.stdout.write("BDFL");'
+                  'sys.stdout.flush(); time.sleep(3600)'],
+                 timeout=0.5, stdout=PIPE)
+    assert b'BDFL' == excinfo.value.stdout
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='lazy loading requires Python 3.7+')
+def test_import_modules():
+    """Check that importing proc doesn't import the heavy modules"""
+    code = ('import sys; import ostrich.utils.proc; '
+            'print(sorted(m for m in ("asyncio", "multiprocessing") '
+            'if m in sys.modules))')
+    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    assert b'[]' == run([sys.executable, '-c', code], cwd=root_dir,
+                        stdout=PIPE, check=True).stdout.strip()
+
+
+def test_stream():
+    """Test streaming output of proc.stream"""
+    with stream([sys.executable, '-c',
+                 'import sys; sys.stdout.write("a\\nb\\n");'
+                 'sys.stdout.flush(); sys.stderr.write("c")']) as proc:
+        items = list(proc)
+    assert [b'a\n', b'b\n'] == [data for name, data in items
+                                if name == 'stdout']
+    assert [('stderr', b'c')] == [item for item in items
+                                  if item[0] == 'stderr']
+    assert 0 == proc.completed.returncode
+
+    with stream([sys.executable, '-c',
+                 'import sys; sys.stdout.write(sys.stdin.read() * 3)'],
+                input=b'x' * 1000, lines=False, chunk_size=100) as proc:
+        chunks = [data for _, data in proc]
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert b'x' * 3000 == b''.join(chunks)
+
+    with pytest.raises(CalledProcessError):
+        with stream([sys.executable, '-c', 'import sys; sys.exit(47)'],
+                    check=True) as proc:
+            list(proc)
+
+
+def test_stream_timeout():
+    """Test that proc.stream times out while streaming"""
+    if not ostrich.utils.proc.__timeout__:
+        return
+
+    lines = []
+    with pytest.raises(TimeoutExpired):
+        with stream([sys.executable, '-c',
+                     'import sys, time; print("BDFL"); sys.stdout.flush();'
+                     'time.sleep(3600)'], timeout=0.5) as proc:
+            for _, line in proc:
+                lines.append(line)
+    assert [b'BDFL'] == [line.strip() for line in lines]
+
+
+def test_stream_timeout_slow_consumer():
+    """Test that proc.stream times out with a child that keeps writing"""
+    if not ostrich.utils.proc.__timeout__:
+        return
+    start = time.time()
+    with pytest.raises(TimeoutExpired):
+        with stream([sys.executable, '-c', 'while True: print("y")'],
+                    timeout=0.5) as proc:
+            for _ in proc:
+                time.sleep(0.01)
+    assert time.time() - start < 3
+
+
+def test_run_capture_bounded():
+    """Test proc.run with bounded output capture"""
+    code = ('import sys; sys.stdout.write("a" * 1000 + "b" * 1000 + "c" * 10);'
+            'sys.stderr.write("err"); sys.exit({0})')
+    cproc = run([sys.executable, '-c', code.format(0)], stdout=PIPE,
+                stderr=PIPE, capture_head=5, capture_tail=10)
+    assert b'aaaaacccccccccc' == cproc.stdout
+    assert 2010 == cproc.stdout_size
+    assert b'err' == cproc.stderr
+    assert 3 == cproc.stderr_size
+
+    cproc = run([sys.executable, '-c', code.format(0)], stdout=PIPE,
+                capture_tail=3, universal_newlines=True)
+    assert 'ccc' == cproc.stdout
+    assert 2010 == cproc.stdout_size
+    assert cproc.stderr_size is None
+
+    with pytest.raises(CalledProcessError) as excinfo:
+        run([sys.executable, '-c', code.format(3)], stdout=PIPE,
+            capture_head=2, check=True)
+    assert b'aa' == excinfo.value.stdout
+    assert 2010 == excinfo.value.stdout_size
+
+    if ostrich.utils.proc.__timeout__:
+        with pytest.raises(TimeoutExpired) as excinfo:
+            run([sys.executable, '-c',
+                 'import sys, time; sys.stdout.write("BDFL" * 100);'
+                 'sys.stdout.flush(); time.sleep(3600)'], timeout=0.5,
+                stdout=PIPE, capture_head=4, capture_tail=4)
+        assert b'BDFLBDFL' == excinfo.value.stdout
+        assert 400 == excinfo.value.stdout_size
+
+
+def test_run_posix_spawn():
+    """Test proc.run with the posix_spawn spawn backend"""
+    cproc = run([sys.executable, '-c',
+                 'import sys, os; sys.stdout.write(sys.stdin.read().upper());'
+                 'sys.stderr.write(os.environ["FRUIT"]); sys.exit(3)'],
+                input=b'spam', stdout=PIPE, stderr=PIPE,
+                env=dict(os.environ, FRUIT='banana'), close_fds=False,
+                spawn_backend='posix_spawn')
+    expected_backend = ('posix_spawn' if ostrich.utils.proc.__posix_spawn__
+                        else 'popen')
+    assert expected_backend == cproc.spawn_backend
+    assert 3 == cproc.returncode
+    assert b'SPAM' == cproc.stdout
+    assert b'banana' == cproc.stderr
+
+    cproc = run('echo BDFL', shell=True, stdout=PIPE, close_fds=False,
+                spawn_backend='posix_spawn')
+    assert b'BDFL' == cproc.stdout.strip()
+
+    # unsupported Popen arguments fall back to Popen
+    cproc = run([sys.executable, '-c', 'print("BDFL")'], stdout=PIPE,
+                cwd=os.path.dirname(sys.executable), close_fds=False,
+                spawn_backend='posix_spawn')
+    assert 'popen' == cproc.spawn_backend
+    assert b'BDFL' == cproc.stdout.strip()
+    # posix_spawn can't close the inherited fds
+    for close_fds in ({}, {'close_fds': True}):
+        cproc = run([sys.executable, '-c', ''], spawn_backend='posix_spawn',
+                    **close_fds)
+        assert 'popen' == cproc.spawn_backend
+
+    assert 'popen' == run([sys.executable, '-c', '']).spawn_backend
+    with pytest.raises(ValueError):
+        run([sys.executable, '-c', ''], spawn_backend='vfork')
+
+
+def test_run_posix_spawn_timeout():
+    """Test timeout with the posix_spawn spawn backend"""
+    if not ostrich.utils.proc.__timeout__:
+        return
+    with pytest.raises(TimeoutExpired) as excinfo:
+        run([sys.executable, '-c',
+             'import sys, time; sys.stdout.write("BDFL");'
+             'sys.stdout.flush(); time.sleep(3600)'], timeout=0.5,
+            stdout=PIPE, close_fds=False, spawn_backend='posix_spawn')
+    assert b'BDFL' == excinfo.value.stdout
+
+
+_ECHO_UPPER = '\n'.join([
+    'import sys',
+    'for line in iter(sys.stdin.readline, ""):',
+    '    line = line.rstrip("\\n")',
+    '    if line == "crash":',
+    '        sys.exit(7)',
+    '    if line == "hang":',
+    '        import time; time.sleep(3600)',
+    '    sys.stdout.write(line.upper() + "\\n")',
+    '    sys.stdout.flush()',
+])
+
+
+def test_coprocess():
+    """Test a Coprocess with line framing, crash and restart"""
+    with Coprocess([sys.executable, '-c', _ECHO_UPPER], framing='line',
+                   health_request=b'ping') as coproc:
+        assert b'SPAM' == coproc.request(b'spam').stdout
+        assert b'EGGS' == coproc.request(b'eggs', timeout=10).stdout
+        assert coproc.check_health(timeout=10)
+        assert 0 == coproc.restarts
+
+        with pytest.raises(CalledProcessError) as excinfo:
+            coproc.request(b'crash')
+        assert 7 == excinfo.value.returncode
+        assert not coproc.is_alive()
+
+        assert b'SPAM' == coproc.request(b'spam').stdout
+        assert 1 == coproc.restarts
+
+        if ostrich.utils.proc.__timeout__:
+            with pytest.raises(TimeoutExpired):
+                coproc.request(b'hang', timeout=0.5)
+            assert b'SPAM' == coproc.request(b'spam').stdout
+            assert 2 == coproc.restarts
+
+
+def test_coprocess_pool():
+    """Test a CoprocessPool with length framing"""
+    echo = '\n'.join([
+        'import struct, sys',
+        'stdin = getattr(sys.stdin, "buffer", sys.stdin)',
+        'stdout = getattr(sys.stdout, "buffer", sys.stdout)',
+        'while True:',
+        '    header = stdin.read(4)',
+        '    if len(header) < 4:',
+        '        break',
+        '    data = stdin.read(struct.unpack(">I", header)[0])',
+        '    stdout.write(header + data[::-1])',
+        '    stdout.flush()',
+    ])
+    with CoprocessPool([sys.executable, '-c', echo], size=2) as pool:
+        assert b'olleh' == pool.request(b'hello').stdout
+        assert b'' == pool.request(b'').stdout
+        assert b'\n\x00' == pool.request(b'\x00\n').stdout
+        assert pool.check_health()
+        assert 2 == len(pool.workers)
+
+
+def test_run_metrics():
+    """Test the metrics of proc.run, and the hooks receiving them"""
+    calls = []
+
+    def hook(args, returncode, metrics):
+        """Record the hook call."""
+        calls.append((args, returncode, metrics))
+
+    add_hook(hook)
+    try:
+        cproc = run([sys.executable, '-c',
+                     'import sys; sys.stdout.write("x" * 100000);'
+                     'sys.exit(3)'], stdout=PIPE)
+    finally:
+        remove_hook(hook)
+    metrics = cproc.metrics
+    assert [(cproc.args, 3, metrics)] == calls
+    assert 100000 == metrics.stdout_bytes
+    assert metrics.stderr_bytes is None
+    assert metrics.kill_time is None
+    assert 0 < metrics.spawn_time <= metrics.wall_time
+    assert (metrics.wall_time >=
+            metrics.spawn_time + metrics.io_time + metrics.wait_time - 1e-6)
+    if hasattr(os, 'wait4'):
+        assert metrics.max_rss > 0
+        assert metrics.user_time + metrics.system_time > 0
+    assert 10 == len(metrics.as_dict())
+
+    run([sys.executable, '-c', ''])
+    assert 1 == len(calls)
+
+
+def test_run_metrics_timeout():
+    """Test that hooks are called with the metrics of timed out runs"""
+    if not ostrich.utils.proc.__timeout__:
+        return
+    calls = []
+    add_hook(lambda *args: calls.append(args))
+    try:
+        with pytest.raises(TimeoutExpired):
+            run([sys.executable, '-c', 'while True: pass'], timeout=0.5)
+    finally:
+        del ostrich.utils.proc._HOOKS[:]  # pylint: disable=protected-access
+    (_, returncode, metrics), = calls
+    assert returncode != 0
+    assert metrics.kill_time is not None
+    assert metrics.wall_time >= 0.5
+
+
+def test_run_timeout_policy():
+    """Test graceful timeout escalation of the process group"""
+    if not ostrich.utils.proc.__timeout__ or not hasattr(os, 'killpg'):
+        return
+
+    # a grandchild keeping stdout open would block the default timeout path
+    start = time.time()
+    with pytest.raises(TimeoutExpired) as excinfo:
+        run('echo BDFL; sleep 3600 & sleep 3600', shell=True, stdout=PIPE,
+            timeout=0.5, timeout_policy=TimeoutPolicy(grace_period=1))
+    assert time.time() - start < 5
+    assert b'BDFL\n' == excinfo.value.stdout
+
+    # a child ignoring SIGTERM is killed after the grace period
+    start = time.time()
+    with pytest.raises(TimeoutExpired):
+        run([sys.executable, '-c',
+             'import signal, time; signal.signal(signal.SIGTERM, '
+             'signal.SIG_IGN); time.sleep(3600)'], timeout=0.5,
+            timeout_policy=TimeoutPolicy(grace_period=0.5, drain_timeout=0.5))
+    assert 1 <= time.time() - start < 5
+
+
+def test_command_cache(tmpdir):
+    """Check that cached results are returned, and invalidated"""
+    uuid_cmd = [sys.executable, '-c', 'import uuid; print(uuid.uuid4())']
+    cache = CommandCache(maxsize=2, directory=str(tmpdir))
+    first = cache.run(uuid_cmd, stdout=PIPE)
+    assert first.stdout == cache.run(uuid_cmd, stdout=PIPE).stdout
+    assert first.metrics is not None
+    assert first.stdout != cache.run(uuid_cmd, stdout=PIPE,
+                                     env={'FOO': 'bar'}).stdout
+    assert {'memory_hits': 1, 'disk_hits': 0, 'misses': 2} == cache.stats()
+    # on-disk results are shared with other caches
+    other_cache = CommandCache(directory=str(tmpdir))
+    assert first.stdout == other_cache.run(uuid_cmd, stdout=PIPE).stdout
+    assert 1 == other_cache.disk_hits
+    cache.invalidate(uuid_cmd, stdout=PIPE)
+    assert first.stdout != cache.run(uuid_cmd, stdout=PIPE).stdout
+    tmpdir.join('settings.json').write('{}')
+    cache.clear()
+    assert [tmpdir.join('settings.json')] == tmpdir.listdir()
+    with pytest.raises(ValueError):
+        cache.run(uuid_cmd, stdout=sys.stdout)
+
+
+def test_command_cache_inputs(tmpdir):
+    """Check that the input and input files are part of the key"""
+    cat_cmd = [sys.executable, '-c',
+               'import sys; sys.stdout.write(open(sys.argv[1]).read() + '
+               'sys.stdin.read())', str(tmpdir.join('input.txt'))]
+    input_file = tmpdir.join('input.txt')
+    for fingerprint in ('stat', 'hash'):
+        cache = CommandCache(fingerprint=fingerprint)
+        for data in ('foo', 'barbaz'):
+            input_file.write(data)
+            os.utime(str(input_file), (0, len(data) * 10))
+            for stdin in (b'1', b'2', b'1'):
+                cproc = cache.run(cat_cmd, input=stdin, stdout=PIPE,
+                                  input_files=[str(input_file)])
+                assert data.encode('ascii') + stdin == cproc.stdout
+        assert 2 == cache.memory_hits
+
+
+def test_command_cache_key(tmpdir):
+    """Check that relative cwds and limits are keyed by their values"""
+    cat_cmd = [sys.executable, '-c', 'print(open("f").read())']
+    cache = CommandCache(directory=str(tmpdir.mkdir('cache')))
+    for name in ('c1', 'c2'):
+        tmpdir.mkdir(name).mkdir('sub').join('f').write(name)
+    with tmpdir.join('c1').as_cwd():
+        assert b'c1' == cache.run(cat_cmd, cwd='sub', stdout=PIPE).stdout[:2]
+    with tmpdir.join('c2').as_cwd():
+        assert b'c2' == cache.run(cat_cmd, cwd='sub', stdout=PIPE).stdout[:2]
+    assert (cache.key(cat_cmd, limits=ResourceLimits(cpu_time=10)) ==
+            cache.key(cat_cmd, limits=ResourceLimits(cpu_time=10)))
+    assert (cache.key(cat_cmd, limits=ResourceLimits(cpu_time=10)) !=
+            cache.key(cat_cmd, limits=ResourceLimits(cpu_time=20)))
+    with pytest.raises(ValueError):
+        cache.key(cat_cmd, preexec_fn=os.getpid)
+    # the on-disk entries are plain JSON, with text and bytes outputs
+    echo_cmd = [sys.executable, '-c', 'print("spam")']
+    for universal_newlines in (False, True):
+        cproc = cache.run(echo_cmd, stdout=PIPE,
+                          universal_newlines=universal_newlines)
+        other_cache = CommandCache(directory=cache.directory)
+        assert cproc.stdout == other_cache.run(
+            echo_cmd, stdout=PIPE,
+            universal_newlines=universal_newlines).stdout
+        assert 1 == other_cache.disk_hits
+    for path in tmpdir.join('cache').listdir():
+        assert path.ext == '.json'
+        json.loads(path.read())
+
+
+def test_command_cache_check():
+    """Check that cached failures raise with check=True"""
+    cache = CommandCache()
+    exit_cmd = [sys.executable, '-c', 'import sys; sys.exit(3)']
+    assert 3 == cache.run(exit_cmd).returncode
+    with pytest.raises(CalledProcessError):
+        cache.run(exit_cmd, check=True)
+    assert 1 == cache.misses
+
+
+def test_pipeline():
+    """Check that large data flows through all stages"""
+    upper = ('import sys; sys.stderr.write("upper"); '
+             'sys.stdout.write(sys.stdin.read().upper())')
+    count = 'import sys; print(len(sys.stdin.read()))'
+    data = b'spam' * (1024 * 1024)
+    results = (Pipeline([sys.executable, '-c', upper])
+               .pipe([sys.executable, '-c', upper], stderr=PIPE)
+               .pipe([sys.executable, '-c', count], stdout=PIPE)
+               .run(input=data, timeout=30, check=True))
+    assert [0, 0, 0] == [result.returncode for result in results]
+    assert [None, None, b'4194304'] == [
+        result.stdout and result.stdout.strip() for result in results]
+    assert b'upper' == results[1].stderr
+
+
+def test_pipeline_pipefail():
+    """Check that check=True raises for the last failing stage"""
+    fail = 'import sys; sys.stdin.read(); sys.exit({0})'
+    pipeline = Pipeline(*[[sys.executable, '-c', fail.format(code)]
+                          for code in (3, 4, 0)])
+    assert [3, 4, 0] == [result.returncode for result in pipeline.run()]
+    with pytest.raises(CalledProcessError) as excinfo:
+        pipeline.run(check=True)
+    assert 4 == excinfo.value.returncode
+    # an early exiting stage kills the previous ones with SIGPIPE
+    results = Pipeline(
+        [sys.executable, '-c', 'while True: print("y" * 100)'],
+        [sys.executable, '-c', 'import sys; sys.stdin.readline()'],
+    ).run(timeout=30)
+    assert [0] == [result.returncode for result in results[1:]]
+    assert 0 != results[0].returncode
+    with pytest.raises(ValueError):
+        Pipeline(['true']).pipe(['true'], stdin=PIPE).run()
+
+
+def test_pipeline_timeout():
+    """Check that all stages are killed when the timeout expires"""
+    sleep = 'import time; time.sleep(5)'
+    start = time.time()
+    with pytest.raises(TimeoutExpired):
+        Pipeline([sys.executable, '-c', sleep],
+                 [sys.executable, '-c', sleep]).run(timeout=0.5)
+    assert time.time() - start < 4
+
+
+def test_run_streamed_input(tmpdir):
+    """Check streaming input from files, paths and iterables"""
+    cat = [sys.executable, '-c',
+           'import sys, shutil; '
+           'shutil.copyfileobj(getattr(sys.stdin, "buffer", sys.stdin), '
+           'getattr(sys.stdout, "buffer", sys.stdout))']
+    data = b'0123456789abcdef' * (256 * 1024)  # more than any pipe buffer
+    input_file = tmpdir.join('input')
+    input_file.write_binary(data)
+    with input_file.open('rb') as input_f:
+        input_f.seek(10)
+        assert data[10:] == run(cat, input=input_f, stdout=PIPE).stdout
+        assert len(data) == input_f.tell()
+    assert data == run(cat, input=io.BytesIO(data), stdout=PIPE).stdout
+    chunks = (data[i:i + 1000] for i in range(0, len(data), 1000))
+    assert data == run(cat, input=chunks, stdout=PIPE).stdout
+    if sys.version_info >= (3, 4):
+        import pathlib
+        cproc = run(cat, input=pathlib.Path(str(input_file)), stdout=PIPE)
+        assert data == cproc.stdout
+    cproc = run(cat, input=iter(['foo\n', 'bar']), stdout=PIPE,
+                universal_newlines=True)
+    assert 'foo\nbar' == cproc.stdout
+
+
+def test_run_streamed_input_error():
+    """Check that errors of the input iterable are raised"""
+    def chunks():
+        yield b'foo'
+        raise RuntimeError('no more')
+    with pytest.raises(RuntimeError):
+        run([sys.executable, '-c', 'import sys; sys.stdin.read()'],
+            input=chunks())
+
+
+def test_run_stdin_pipe_without_input():
+    """Check that an input pipe without input is just closed"""
+    read = [sys.executable, '-c', 'import sys; print(len(sys.stdin.read()))']
+    cproc = run(read, stdin=PIPE, stdout=PIPE, timeout=10)
+    assert b'0' == cproc.stdout.strip()
+    with stream(read, stdin=PIPE) as proc:
+        assert [('stdout', b'0')] == [(name, line.strip())
+                                      for name, line in proc]
+    pipeline = Pipeline().pipe(read, stdin=PIPE, stdout=PIPE)
+    assert b'0' == pipeline.run(timeout=10)[0].stdout.strip()
+
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason='POSIX only')
+def test_run_limits():
+    """Check that the limits are applied, and the usage is reported"""
+    cproc = run([sys.executable, '-c', 'print(len(bytearray(10 ** 7)))'],
+                stdout=PIPE, limits=ResourceLimits(address_space=2 ** 32,
+                                                   open_files=64))
+    assert b'10000000' == cproc.stdout.strip()
+    assert cproc.metrics.max_rss >= 10 ** 7
+    with pytest.raises(CalledProcessError) as excinfo:
+        run([sys.executable, '-c', 'bytearray(2 ** 31)'], stderr=PIPE,
+            check=True, limits=ResourceLimits(address_space=2 ** 30))
+    assert b'MemoryError' in excinfo.value.stderr
+    assert not isinstance(excinfo.value, ResourceLimitExceeded)
+    cproc = run([sys.executable, '-c',
+                 'import os; [os.open(os.devnull, os.O_RDONLY) '
+                 'for _ in range(100)]'],
+                stderr=PIPE, limits=ResourceLimits(open_files=32))
+    assert 0 != cproc.returncode
+    assert b'Too many open files' in cproc.stderr
+
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason='POSIX only')
+def test_run_limits_exceeded():
+    """Check that a child killed by a limit raises ResourceLimitExceeded"""
+    with pytest.raises(ResourceLimitExceeded) as excinfo:
+        run([sys.executable, '-c', 'while True: pass'], timeout=30,
+            limits=ResourceLimits(cpu_time=1))
+    assert 'cpu_time' == excinfo.value.limit
+    assert (excinfo.value.metrics.user_time +
+            excinfo.value.metrics.system_time) >= 0.9
+    with pytest.raises(ResourceLimitExceeded) as excinfo:
+        run([sys.executable, '-c', 'while True: print("y" * 99)'],
+            stdout=PIPE, timeout=30, limits=ResourceLimits(output_size=10000))
+    assert 'output_size' == excinfo.value.limit
+    assert b'y' * 99 + b'\n' == excinfo.value.output[:100]
+    assert 10000 == len(excinfo.value.output)
+    # the process is reaped only by wait4(), so its usage is collected
+    assert excinfo.value.metrics.max_rss is not None
@@ -7,9 +7,14 @@
 
 from __future__ import unicode_literals
 
+import io
+import mmap
+
 import pytest
 
-from ostrich.utils.text import get_safe_path
+from ostrich.utils.collections import LRUCache
+from ostrich.utils.text import (
+    as_text, get_safe_path, get_safe_paths, iter_text, SafePathAllocator)
 
 
 def test_safe_path_spaces():
@@ -51,3 +56,118 @@ def test_safe_path_only_dot_err():
 def test_safe_path_too_long():
     """Check that a long path name is trimmed to 255 characters"""
     assert 255 == len(get_safe_path(''.join('a' for _ in range(5000))))
+
+
+def test_safe_path_cache():
+    """Check that cached results are reused, and the cache is bounded"""
+    cache = LRUCache(maxsize=2)
+    for in_str in ('foo bar', 'foo bar', b'foo?', 'foo bar', '\u00f6'):
+        assert get_safe_path(in_str) == get_safe_path(in_str, cache=cache)
+    assert (2, 3, 2) == (cache.hits, cache.misses, len(cache))
+    assert b'foo?' not in cache
+    with pytest.raises(ValueError):
+        get_safe_path('..', cache=cache)
+    assert '..' not in cache
+
+
+def test_safe_paths():
+    """Check the batch API, with and without a shared cache"""
+    in_strs = ['a b', ' \u00f6 ', b'c?', 'a b']
+    assert ['a_b', 'o_', 'c_', 'a_b'] == get_safe_paths(iter(in_strs))
+    cache = LRUCache()
+    get_safe_paths(in_strs, cache=cache)
+    assert ['a_b', 'o_', 'c_', 'a_b'] == get_safe_paths(in_strs, cache=cache)
+    assert (5, 3) == (cache.hits, cache.misses)
+    with pytest.raises(ValueError):
+        get_safe_paths(['foo', ''])
+
+
+def test_safe_path_allocator():
+    """Check that allocated names are unique per directory"""
+    allocator = SafePathAllocator()
+    names = allocator.allocate_many(['foo.txt', 'foo.txt', 'foo_1.txt'])
+    assert ['foo.txt', 'foo_1.txt', 'foo_1_1.txt'] == names
+    assert 'foo_2.txt' == allocator.allocate('foo.txt')
+    assert 'foo.txt' == allocator.allocate('foo.txt', directory='bar')
+    allocator.release('foo.txt')
+    assert 'foo.txt' == allocator.allocate('foo.txt')
+    allocator.reserve('baz')
+    assert 'baz_1' == allocator.allocate('baz')
+
+
+def test_safe_path_allocator_long():
+    """Check that suffixed names are trimmed to 255 characters"""
+    allocator = SafePathAllocator()
+    names = allocator.allocate_many(['a' * 300 + '.txt'] * 12)
+    assert len(set(names)) == 12
+    assert all(255 == len(name) for name in names)
+    assert names[-1].endswith('_11')
+    names = allocator.allocate_many(['b' * 300] * 2)
+    assert names[1] == 'b' * 253 + '_1'
+
+
+def test_safe_path_allocator_case_insensitive():
+    allocator = SafePathAllocator(case_sensitive=False)
+    assert ['Foo', 'foo_1'] == allocator.allocate_many(['Foo', 'foo'])
+
+
+def test_safe_path_allocator_scan(tmpdir):
+    """Check that existing entries are avoided when scanning"""
+    tmpdir.join('foo.txt').write('')
+    tmpdir.mkdir('bar')
+    allocator = SafePathAllocator(scan=True)
+    assert (['foo_1.txt', 'bar_1'] ==
+            allocator.allocate_many(['foo.txt', 'bar'], str(tmpdir)))
+    assert 'foo.txt' == SafePathAllocator().allocate('foo.txt', str(tmpdir))
+    assert 'foo.txt' == allocator.allocate('foo.txt',
+                                           str(tmpdir.join('missing')))
+
+
+def test_iter_text_split_chars():
+    """Check that multi-byte characters split across chunks are decoded"""
+    data = 'a\u00f6b\u20ac\n\U0001f600c\nd'.encode('utf-8')
+    for size in range(1, len(data) + 1):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        assert data.decode('utf-8') == ''.join(iter_text(chunks))
+        assert (['a\u00f6b\u20ac\n', '\U0001f600c\n', 'd'] ==
+                list(iter_text(chunks, lines=True)))
+        assert (['a\u00f6b\u20ac\n', '\U0001f600c\n', 'd'] ==
+                list(iter_text(io.BytesIO(data), lines=True,
+                               chunk_size=size)))
+
+
+def test_iter_text_encoding():
+    data = 'foo\nbar'.encode('utf-16')
+    assert ['foo\n', 'bar'] == list(iter_text(io.BytesIO(data), 'utf-16',
+                                              lines=True, chunk_size=3))
+    assert ['foo', 'bar'] == list(iter_text(['foo', b'bar']))
+
+
+def test_iter_text_errors():
+    """Check that decoding errors are handled like as_text does"""
+    with pytest.raises(UnicodeDecodeError):
+        list(iter_text([b'foo\xc3']))
+    assert ('foo\ufffd' ==
+            ''.join(iter_text([b'fo', b'o\xc3'], errors='replace')))
+    assert [] == list(iter_text(io.BytesIO(b''), lines=True))
+
+
+def test_as_text_buffers(tmpdir):
+    """Check that bytes-like objects are decoded (in place)"""
+    data = 'caf\u00e9 bar'.encode('utf-8')
+    assert 'caf\u00e9 bar' == as_text(bytearray(data))
+    assert 'caf\u00e9' == as_text(memoryview(data)[:5])
+    assert '\ufffd' == as_text(memoryview(data)[4:5], errors='replace')
+    path = tmpdir.join('data')
+    path.write_binary(data)
+    with path.open('rb') as data_f:
+        mapped = mmap.mmap(data_f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            assert 'caf\u00e9 bar' == as_text(mapped)
+            assert ('caf\u00e9 bar' ==
+                    ''.join(iter_text(memoryview(mapped)[i:i + 2]
+                                      for i in range(0, len(data), 2))))
+        finally:
+            mapped.close()
+    assert 'foo_bar' == get_safe_path(memoryview(b'foo bar'),
+                                      cache=LRUCache())